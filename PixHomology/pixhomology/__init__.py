@@ -1,2 +1,15 @@
-from .pixhom import computePH
-from . import exp
+# the shared libraries are loaded on first use, importing pixhomology.exp does not load libpixhom
+
+
+def __getattr__(name):
+    if name == 'computePH':
+        from .pixhom import computePH
+        return computePH
+    if name == 'exp':
+        from . import exp
+        return exp
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + ['computePH', 'exp'])
@@ -1 +1 @@
-from .graphom import image_to_graph, graph_to_image
\ No newline at end of file
+from .graphom import image_to_graph, image_to_tree_arrays, graph_to_image
\ No newline at end of file
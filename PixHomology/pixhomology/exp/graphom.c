@@ -5,6 +5,12 @@
 #include <math.h>
 #include <time.h>
 #include <float.h>
+#include <string.h>
+#include <stdint.h>
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 #define MODULE_API_EXPORTS
 #include "graphom.h"
@@ -103,44 +109,291 @@ int compareUPoints(const void *a, const void *b) {
 }
 
 
-// Persistent Homology dimension 0 function
-MODULE_API Graph computeGraph(double *inputArray, int numRows, int numCols) {
+// Order-preserving map from a double to an unsigned key: larger values give smaller keys
+static inline uint64_t descendingKey(double value) {
+    uint64_t bits;
+    // -0.0 and 0.0 compare equal
+    if (value == 0) {
+        value = 0.0;
+    }
+    memcpy(&bits, &value, sizeof(bits));
+    bits = (bits & 0x8000000000000000ULL) ? ~bits : (bits | 0x8000000000000000ULL);
+    return ~bits;
+}
 
-    // Calculate Argmin and Argmax
-    MinMaxIndices argMinMax = findArgminArgmax(inputArray, numRows * numCols);
+// Radix sort of (key, index) pairs, RADIX_BITS bits per pass
+#define RADIX_BITS 16
+#define RADIX_SIZE (1 << RADIX_BITS)
+#define RADIX_PASSES (64 / RADIX_BITS)
+
+typedef struct {
+    uint64_t key;
+    int index;
+} RadixItem;
+
+// Stable LSD passes over the keys, returns the buffer (src or dst) holding the sorted items
+static RadixItem *radixPasses(RadixItem *src, RadixItem *dst, int size, int *counts) {
+    // Histograms of every digit in a single read
+    memset(counts, 0, RADIX_PASSES * RADIX_SIZE * sizeof(int));
+    for (int i = 0; i < size; i++) {
+        uint64_t key = src[i].key;
+        for (int d = 0; d < RADIX_PASSES; d++) {
+            counts[d * RADIX_SIZE + ((key >> (d * RADIX_BITS)) & (RADIX_SIZE - 1))]++;
+        }
+    }
 
-    
-    // Allocate memory for the edges and weights arrays
-    int *edges = malloc(numRows * numCols * sizeof(int));
-    double *weights = malloc(numRows * numCols * sizeof(double));
+    for (int d = 0; d < RADIX_PASSES; d++) {
+        int shift = d * RADIX_BITS;
+        int *count = counts + d * RADIX_SIZE;
 
-    // Allocate memory for the array of UPoints
-    UPoint *u_points = malloc(1 * sizeof(UPoint));
-    int num_u_points = 0;
+        // Skip the pass when every key has the same digit
+        if (count[(src[0].key >> shift) & (RADIX_SIZE - 1)] == size) {
+            continue;
+        }
 
-    // Set up edges array
-    for (int i = 0; i < numRows * numCols; i++) {
-        edges[i] = i;
-        weights[i] = 0;
+        int offset = 0;
+        for (int b = 0; b < RADIX_SIZE; b++) {
+            int c = count[b];
+            count[b] = offset;
+            offset += c;
+        }
+
+        for (int i = 0; i < size; i++) {
+            dst[count[(src[i].key >> shift) & (RADIX_SIZE - 1)]++] = src[i];
+        }
+
+        RadixItem *tmp = src;
+        src = dst;
+        dst = tmp;
     }
+    return src;
+}
 
-    // First pass to find local maxima
+// Stable LSD radix sort of u_points by decreasing u_val, then decreasing c_val.
+// It gives the same order as a stable sort with compareUPoints
+static int radixSortUPoints(UPoint *u_points, int num_u_points) {
+    if (num_u_points < 2) {
+        return 0;
+    }
+
+    RadixItem *items = malloc(num_u_points * sizeof(RadixItem));
+    RadixItem *buffer = malloc(num_u_points * sizeof(RadixItem));
+    UPoint *sorted = malloc(num_u_points * sizeof(UPoint));
+    int *counts = malloc(RADIX_PASSES * RADIX_SIZE * sizeof(int));
+    if (items == NULL || buffer == NULL || sorted == NULL || counts == NULL) {
+        free(items);
+        free(buffer);
+        free(sorted);
+        free(counts);
+        return -1;
+    }
+
+    // Sort by the least significant key (c_val) first, then by u_val
+    for (int i = 0; i < num_u_points; i++) {
+        items[i].key = descendingKey(u_points[i].c_val);
+        items[i].index = i;
+    }
+    RadixItem *src = radixPasses(items, buffer, num_u_points, counts);
+    RadixItem *dst = (src == items) ? buffer : items;
+
+    for (int i = 0; i < num_u_points; i++) {
+        src[i].key = descendingKey(u_points[src[i].index].u_val);
+    }
+    src = radixPasses(src, dst, num_u_points, counts);
+
+    for (int i = 0; i < num_u_points; i++) {
+        sorted[i] = u_points[src[i].index];
+    }
+    memcpy(u_points, sorted, num_u_points * sizeof(UPoint));
+
+    free(items);
+    free(buffer);
+    free(sorted);
+    free(counts);
+    return 0;
+}
+
+// Disjoint-set find with path halving
+static int findSet(int *sets, int x) {
+    while (sets[x] != x) {
+        sets[x] = sets[sets[x]];
+        x = sets[x];
+    }
+    return x;
+}
+
+// Disjoint-set union by rank, returns the representative of the merged set
+static int unionSets(int *sets, unsigned char *rank, int a, int b) {
+    if (rank[a] < rank[b]) {
+        int tmp = a;
+        a = b;
+        b = tmp;
+    }
+    sets[b] = a;
+    if (rank[a] == rank[b]) {
+        rank[a]++;
+    }
+    return a;
+}
+
+// Append a UPoint, doubling the capacity of the array when it is full
+static int appendUPoint(UPoint **u_points, int *num_u_points, int *cap_u_points, UPoint point) {
+    if (*num_u_points == *cap_u_points) {
+        int new_cap = 2 * (*cap_u_points);
+        UPoint *tmp = realloc(*u_points, new_cap * sizeof(UPoint));
+        if (tmp == NULL) {
+            return -1;
+        }
+        *u_points = tmp;
+        *cap_u_points = new_cap;
+    }
+    (*u_points)[(*num_u_points)++] = point;
+    return 0;
+}
+
+// Number of threads for the parallel passes, numThreads <= 0 selects the OpenMP default
+static int resolveThreads(int numThreads) {
+#ifdef _OPENMP
+    return (numThreads > 0) ? numThreads : omp_get_max_threads();
+#else
+    (void) numThreads;
+    return 1;
+#endif
+}
+
+// Find u_points for the rows in [rowStart, rowEnd), appending them in row-major order
+static int findUPoints(const double *inputArray, const int *roots, int numRows, int numCols,
+                       int rowStart, int rowEnd, UPoint **u_points, int *num_u_points, int *cap_u_points) {
+    for (int i = rowStart; i < rowEnd; i++) {
+        for (int j = 0; j < numCols; j++) {
+            int x_start = (i > 0) ? (i - 1) : 0;
+            int y_start = (j > 0) ? (j - 1) : 0;
+            int x_end = (i < (numRows - 1)) ? (i + 1) : (numRows - 1);
+            int y_end = (j < (numCols - 1)) ? (j + 1) : (numCols - 1);
+
+            int c_point = i * numCols + j;
+
+            int u_point = c_point;
+            double u_val = inputArray[u_point];
+
+            for (int h = x_start; h <= x_end; h++) {
+                for (int k = y_start; k <= y_end; k++) {
+                    int t_point = h * numCols + k;
+
+                    int c_obj = roots[c_point];
+                    int t_obj = roots[t_point];
+
+                    double c_val = inputArray[c_point];
+                    double t_val = inputArray[t_point];
+
+                    if (c_point != t_point && c_obj != t_obj && ((c_val > t_val) || ((c_val == t_val) && (c_point > t_point)))) {
+                        u_point = t_point;
+                        u_val = inputArray[u_point];
+
+                        // Store information about u_point in the u_points array
+                        UPoint point = { u_val, c_val, c_point, u_point };
+                        if (appendUPoint(u_points, num_u_points, cap_u_points, point) != 0) {
+                            return -1;
+                        }
+                    }
+                }
+            }
+        }
+    }
+    return 0;
+}
+
+// Find u_points with one buffer per row block, then concatenate the blocks in order so
+// that the result does not depend on the number of threads
+static UPoint *collectUPoints(const double *inputArray, const int *roots, int numRows, int numCols,
+                              int threads, int *num_u_points) {
+    UPoint **local_points = calloc(threads, sizeof(UPoint *));
+    int *local_num = calloc(threads, sizeof(int));
+    int failed = 0;
+    if (local_points == NULL || local_num == NULL) {
+        free(local_points);
+        free(local_num);
+        return NULL;
+    }
+
+    #pragma omp parallel num_threads(threads) reduction(|:failed)
+    {
+#ifdef _OPENMP
+        int t = omp_get_thread_num();
+        int nt = omp_get_num_threads();
+#else
+        int t = 0;
+        int nt = 1;
+#endif
+        int rowStart = (int) ((long long) numRows * t / nt);
+        int rowEnd = (int) ((long long) numRows * (t + 1) / nt);
+
+        // The array of UPoints grows geometrically, starting from one UPoint per pixel
+        int cap = ((rowEnd - rowStart) * numCols > 0) ? (rowEnd - rowStart) * numCols : 1;
+        local_points[t] = malloc(cap * sizeof(UPoint));
+        if (local_points[t] == NULL ||
+            findUPoints(inputArray, roots, numRows, numCols, rowStart, rowEnd, &local_points[t], &local_num[t], &cap) != 0) {
+            failed = 1;
+        }
+    }
+
+    int total = 0;
+    for (int t = 0; t < threads; t++) {
+        total += local_num[t];
+    }
+
+    UPoint *u_points = NULL;
+    if (!failed && threads == 1) {
+        // A single block is already in order
+        u_points = local_points[0];
+        local_points[0] = NULL;
+        *num_u_points = total;
+    } else if (!failed) {
+        u_points = malloc((total > 0 ? total : 1) * sizeof(UPoint));
+    }
+    if (u_points != NULL && threads > 1) {
+        int offset = 0;
+        for (int t = 0; t < threads; t++) {
+            if (local_num[t] > 0) {
+                memcpy(u_points + offset, local_points[t], local_num[t] * sizeof(UPoint));
+            }
+            offset += local_num[t];
+        }
+        *num_u_points = total;
+    }
+
+    for (int t = 0; t < threads; t++) {
+        free(local_points[t]);
+    }
+    free(local_points);
+    free(local_num);
+    return u_points;
+}
+
+// First pass: point every pixel to the maximum of its 3x3 neighbourhood
+static int findLocalMaxima(const double *inputArray, int numRows, int numCols, int *roots, int threads) {
     // Create padded array to handle boundaries with -inf
     double* paddedArray = (double*)malloc((numRows + 2) * (numCols + 2) * sizeof(double));
+    if (paddedArray == NULL) {
+        return -1;
+    }
 
     // Initialize padded array to -inf
+    #pragma omp parallel for num_threads(threads) schedule(static)
     for (int i = 0; i < (numRows + 2) * (numCols + 2); i++) {
         paddedArray[i] = -DBL_MAX;
     }
 
     // Copy inputArray into the paddedArray (shifted by 1)
+    #pragma omp parallel for num_threads(threads) schedule(static)
     for (int i = 0; i < numRows; i++) {
         for (int j = 0; j < numCols; j++) {
             paddedArray[(i + 1) * (numCols + 2) + (j + 1)] = inputArray[i * numCols + j];
         }
     }
 
-    // Iterate over the original image dimensions
+    // Iterate over the original image dimensions, one block of rows per thread
+    #pragma omp parallel for num_threads(threads) schedule(static)
     for (int i = 0; i < numRows; i++) {
         for (int j = 0; j < numCols; j++) {
             int c_point = i * numCols + j;
@@ -165,113 +418,251 @@ MODULE_API Graph computeGraph(double *inputArray, int numRows, int numCols) {
             // Convert local maxIdx to the original (flattened) index
             int ni = i + (maxIdx / 3) - 1; // Adjust back to non-padded index
             int nj = j + (maxIdx % 3) - 1;
-            edges[c_point] = ni * numCols + nj;
+            roots[c_point] = ni * numCols + nj;
         }
     }
 
     // Free allocated memory for the padded array
     free(paddedArray);
+    return 0;
+}
 
-    // Second pass to update the edges array
+// Second pass: pointer jumping until every pixel points to its root.
+// Each round reads from one buffer and writes to the other, so the result does not
+// depend on the number of threads. If weights is not NULL, every pixel that moves
+// gets the value difference to its new target.
+static int jumpPointers(const double *inputArray, int *roots, double *weights, int size, int threads) {
+    int *buffer = malloc((size > 0 ? size : 1) * sizeof(int));
+    if (buffer == NULL) {
+        return -1;
+    }
+
+    int *current = roots;
+    int *next = buffer;
     while (1) {
         int changed = 0;
-        for (int i = 0; i < numRows * numCols; i++) {
-            if (edges[i] != edges[edges[i]]) {
-                edges[i] = edges[edges[i]];
-                weights[i] = (inputArray[edges[edges[i]]] - inputArray[i]);
+        #pragma omp parallel for num_threads(threads) schedule(static) reduction(|:changed)
+        for (int i = 0; i < size; i++) {
+            int target = current[current[i]];
+            next[i] = target;
+            if (current[i] != target) {
+                if (weights != NULL) {
+                    weights[i] = (inputArray[target] - inputArray[i]);
+                }
                 changed = 1;
             }
         }
+
+        int *tmp = current;
+        current = next;
+        next = tmp;
+
         if (!changed) {
             break;
         }
     }
 
-    // Find u_points
-    for (int i = 0; i < numRows; i++) {
-        for (int j = 0; j < numCols; j++) {
-            int x_start = (i > 0) ? (i - 1) : 0;
-            int y_start = (j > 0) ? (j - 1) : 0;
-            int x_end = (i < (numRows - 1)) ? (i + 1) : (numRows - 1);
-            int y_end = (j < (numCols - 1)) ? (j + 1) : (numCols - 1);
-
-            int c_point = i * numCols + j;
-
-            int u_point = c_point;
-            double u_val = inputArray[u_point];
-
-            for (int h = x_start; h <= x_end; h++) {
-                for (int k = y_start; k <= y_end; k++) {
-                    int t_point = h * numCols + k;
-
-                    int c_obj = edges[c_point];
-                    int t_obj = edges[t_point];
-
-                    double c_val = inputArray[c_point];
-                    double t_val = inputArray[t_point];
-
-                    if (c_point != t_point && c_obj != t_obj && ((c_val > t_val) || ((c_val == t_val) && (c_point > t_point)))) {
-                        u_points = realloc(u_points, (1 + num_u_points) * sizeof(UPoint));
+    if (current != roots) {
+        memcpy(roots, current, size * sizeof(int));
+    }
+    free(buffer);
+    return 0;
+}
 
-                        u_point = t_point;
-                        u_val = inputArray[u_point];
+// Build the merge graph into edges; weights may be NULL when they are not needed
+static int buildGraph(const double *inputArray, int numRows, int numCols, int *edges, double *weights, int threads) {
+    // Set up weights array
+    if (weights != NULL) {
+        for (int i = 0; i < numRows * numCols; i++) {
+            weights[i] = 0;
+        }
+    }
 
-                        // Store information about u_point in the u_points array
-                        u_points[num_u_points].u_val = u_val;
-                        u_points[num_u_points].c_val = c_val;
-                        u_points[num_u_points].c_point = c_point;
-                        u_points[num_u_points].u_point = u_point;
+    // First pass to find local maxima
+    if (findLocalMaxima(inputArray, numRows, numCols, edges, threads) != 0) {
+        return -1;
+    }
 
-                        num_u_points++;
+    // Second pass to update the edges array
+    if (jumpPointers(inputArray, edges, weights, numRows * numCols, threads) != 0) {
+        return -1;
+    }
 
-                    }
-                }
-            }
-        }
+    // Find u_points
+    int num_u_points = 0;
+    UPoint *u_points = collectUPoints(inputArray, edges, numRows, numCols, threads, &num_u_points);
+    if (u_points == NULL) {
+        return -1;
     }
 
     // Sort u_points in descending order
+#ifdef PIXHOM_USE_QSORT
     qsort(u_points, num_u_points, sizeof(*u_points), compareUPoints);
+#else
+    if (radixSortUPoints(u_points, num_u_points) != 0) {
+        free(u_points);
+        return -1;
+    }
+#endif
+
+    // Disjoint sets of the merged components: edges keeps the graph, while sets is compressed
+    // and owner stores the surviving (oldest) root of each set
+    int *sets = malloc(numRows * numCols * sizeof(int));
+    int *owner = malloc(numRows * numCols * sizeof(int));
+    unsigned char *rank = calloc(numRows * numCols, sizeof(unsigned char));
+    if (sets == NULL || owner == NULL || rank == NULL) {
+        free(sets);
+        free(owner);
+        free(rank);
+        free(u_points);
+        return -1;
+    }
+
+    // After the second pass every pixel points directly to its root
+    #pragma omp parallel for num_threads(threads) schedule(static)
+    for (int i = 0; i < numRows * numCols; i++) {
+        sets[i] = edges[i];
+        owner[i] = i;
+    }
 
     // Find dgm
     for (int i = 0; i < num_u_points; i++) {
         int c_point = u_points[i].c_point;
         int u_point = u_points[i].u_point;
 
-        int c_obj = c_point;
-        int u_obj = u_point;
+        int c_set = findSet(sets, c_point);
+        int u_set = findSet(sets, u_point);
 
-        while (c_obj != edges[c_obj]) {
-            c_obj = edges[c_obj];
-        }
-        while (u_obj != edges[u_obj]) {
-            u_obj = edges[u_obj];
-        }
+        if (c_set != u_set) {
+            int c_obj = owner[c_set];
+            int u_obj = owner[u_set];
 
-        if (c_obj != u_obj) {
-            if (inputArray[c_obj] > inputArray[u_obj]) {
-                edges[u_obj] = c_point;
-                weights[u_obj] = (inputArray[c_obj] - inputArray[u_obj]);
-            } else if (inputArray[c_obj] < inputArray[u_obj]) {
-                edges[c_obj] = u_point;
-                weights[c_obj] = (inputArray[u_obj] - inputArray[c_obj]);
-            } else{
-                if (c_obj > u_obj){
-                    edges[u_obj] = c_point;
-                    weights[u_obj] = (inputArray[c_obj] - inputArray[u_obj]);
-                }else{
-                    edges[c_obj] = u_point;
-                    weights[c_obj] = (inputArray[u_obj] - inputArray[c_obj]);
-                }
+            // The younger root is linked to the merging pixel of the older component
+            int c_wins = (inputArray[c_obj] > inputArray[u_obj]) ||
+                         (inputArray[c_obj] == inputArray[u_obj] && c_obj > u_obj);
+            int dead = c_wins ? u_obj : c_obj;
+            int survivor = c_wins ? c_obj : u_obj;
 
+            edges[dead] = c_wins ? c_point : u_point;
+            if (weights != NULL) {
+                weights[dead] = (inputArray[survivor] - inputArray[dead]);
             }
+            owner[unionSets(sets, rank, c_set, u_set)] = survivor;
         }
     }
 
     //Clean
+    free(sets);
+    free(owner);
+    free(rank);
     free(u_points);
 
-    Graph res = { edges, weights };
-    return res; 
-    
+    return 0;
+}
+
+// Persistent Homology dimension 0 function
+// The edges and weights arrays (numRows * numCols elements each) are allocated by the caller,
+// numThreads <= 0 uses the OpenMP default number of threads
+MODULE_API int computeGraph(const double *inputArray, int numRows, int numCols, int *edges, double *weights, int numThreads) {
+    return buildGraph(inputArray, numRows, numCols, edges, weights, resolveThreads(numThreads));
+}
+
+// Persistent tree of an image in a single call.
+// All arrays are allocated by the caller with numRows * numCols elements. On return parents holds
+// the parent of every pixel (-1 for the root), labels the component of every pixel, and the first
+// K entries of components, births and deaths the sorted component labels with their maximum and
+// minimum value, where K is the return value. root receives the first pixel with the maximum value.
+// Returns -1 on allocation failure
+MODULE_API int computeTree(const double *inputArray, int numRows, int numCols, int *parents, int *labels,
+                           int *components, double *births, double *deaths, int *root, int numThreads) {
+    int threads = resolveThreads(numThreads);
+    int size = numRows * numCols;
+
+    if (size == 0) {
+        *root = -1;
+        return 0;
+    }
+
+    // Merge graph, every pixel points to its parent and roots point to themselves
+    if (buildGraph(inputArray, numRows, numCols, parents, NULL, threads) != 0) {
+        return -1;
+    }
+
+    // A pixel whose 8 neighbours share the same parent takes it as label,
+    // border pixels and all other pixels keep their own parent
+    #pragma omp parallel for num_threads(threads) schedule(static)
+    for (int i = 0; i < numRows; i++) {
+        for (int j = 0; j < numCols; j++) {
+            int c_point = i * numCols + j;
+            int label = parents[c_point];
+
+            if (i > 0 && i < numRows - 1 && j > 0 && j < numCols - 1) {
+                int first = parents[c_point - numCols - 1];
+                int same = 1;
+                for (int h = -1; h <= 1 && same; h++) {
+                    for (int k = -1; k <= 1; k++) {
+                        if ((h != 0 || k != 0) && parents[c_point + h * numCols + k] != first) {
+                            same = 0;
+                            break;
+                        }
+                    }
+                }
+                if (same) {
+                    label = first;
+                }
+            }
+            labels[c_point] = label;
+        }
+    }
+
+    // Roots of the merge graph have no parent
+    #pragma omp parallel for num_threads(threads) schedule(static)
+    for (int i = 0; i < size; i++) {
+        if (parents[i] == i) {
+            parents[i] = -1;
+        }
+    }
+
+    // Sorted component labels, slot maps a label to its position in components
+    int *slot = malloc(size * sizeof(int));
+    if (slot == NULL) {
+        return -1;
+    }
+    for (int i = 0; i < size; i++) {
+        slot[i] = -1;
+    }
+    for (int i = 0; i < size; i++) {
+        slot[labels[i]] = 0;
+    }
+    int num_components = 0;
+    for (int i = 0; i < size; i++) {
+        if (slot[i] == 0) {
+            components[num_components] = i;
+            slot[i] = num_components++;
+        }
+    }
+
+    // Birth (maximum) and death (minimum) of every component
+    for (int k = 0; k < num_components; k++) {
+        births[k] = -INFINITY;
+        deaths[k] = INFINITY;
+    }
+    int max_index = 0;
+    for (int i = 0; i < size; i++) {
+        int k = slot[labels[i]];
+        double value = inputArray[i];
+        if (value > births[k]) {
+            births[k] = value;
+        }
+        if (value < deaths[k]) {
+            deaths[k] = value;
+        }
+        if (value > inputArray[max_index]) {
+            max_index = i;
+        }
+    }
+    *root = max_index;
+
+    free(slot);
+    return num_components;
 }
@@ -13,12 +13,6 @@ extern "C" {
 #endif
 
 
-// Define a struct to store the result
-typedef struct {
-    int *edges;
-    double *weights;
-} Graph;
-
 // Define a struct to store information about u_points
 typedef struct {
     double u_val;
@@ -45,7 +39,14 @@ int compareUPoints(const void *a, const void *b);
 
 
 // Persistent Homology dimension 0 function
-MODULE_API Graph computePH(double *inputArray, int numRows, int numCols);
+// Writes into caller-allocated edges and weights arrays, returns 0 on success and -1 on allocation failure.
+// numThreads <= 0 uses the OpenMP default number of threads
+MODULE_API int computeGraph(const double *inputArray, int numRows, int numCols, int *edges, double *weights, int numThreads);
+
+// Persistent tree (parents, labels and sorted components with their birth and death) in a single call.
+// Writes into caller-allocated arrays, returns the number of components or -1 on allocation failure
+MODULE_API int computeTree(const double *inputArray, int numRows, int numCols, int *parents, int *labels,
+                           int *components, double *births, double *deaths, int *root, int numThreads);
 
 #ifdef __cplusplus
 }
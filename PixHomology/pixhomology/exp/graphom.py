@@ -3,11 +3,6 @@ import ctypes
 from pathlib import Path
 import sys
 
-# Define the Result structure in Python
-class Graph(ctypes.Structure):
-    _fields_ = [("edges", ctypes.POINTER(ctypes.c_int)),
-                ("weights", ctypes.POINTER(ctypes.c_double))]
-
 # Define the C PixHomology function
 #print(Path(__file__).parent.parent)
 
@@ -33,12 +28,44 @@ graphom = ctypes.CDLL(str(path / name))
 
 graphom.computeGraph.argtypes = [np.ctypeslib.ndpointer(dtype=np.float64, ndim=2, flags='C_CONTIGUOUS'),
                                  ctypes.c_int,
+                                 ctypes.c_int,
+                                 np.ctypeslib.ndpointer(dtype=np.intc, ndim=2, flags='C_CONTIGUOUS,WRITEABLE'),
+                                 np.ctypeslib.ndpointer(dtype=np.float64, ndim=2, flags='C_CONTIGUOUS,WRITEABLE'),
                                  ctypes.c_int]
-graphom.computeGraph.restype = Graph
+graphom.computeGraph.restype = ctypes.c_int
+
+graphom.computeTree.argtypes = [np.ctypeslib.ndpointer(dtype=np.float64, ndim=2, flags='C_CONTIGUOUS'),
+                                ctypes.c_int,
+                                ctypes.c_int,
+                                np.ctypeslib.ndpointer(dtype=np.intc, ndim=1, flags='C_CONTIGUOUS,WRITEABLE'),
+                                np.ctypeslib.ndpointer(dtype=np.intc, ndim=1, flags='C_CONTIGUOUS,WRITEABLE'),
+                                np.ctypeslib.ndpointer(dtype=np.intc, ndim=1, flags='C_CONTIGUOUS,WRITEABLE'),
+                                np.ctypeslib.ndpointer(dtype=np.float64, ndim=1, flags='C_CONTIGUOUS,WRITEABLE'),
+                                np.ctypeslib.ndpointer(dtype=np.float64, ndim=1, flags='C_CONTIGUOUS,WRITEABLE'),
+                                ctypes.POINTER(ctypes.c_int),
+                                ctypes.c_int]
+graphom.computeTree.restype = ctypes.c_int
+
+
+def _check_output(out, shape, dtype, name):
+    if out is None:
+        return np.empty(shape, dtype=dtype)
+    if not isinstance(out, np.ndarray) or out.shape != shape or out.dtype != dtype:
+        raise ValueError(f"{name} must be a NumPy array with shape {shape} and dtype '{np.dtype(dtype)}'")
+    if not out.flags.c_contiguous or not out.flags.writeable:
+        raise ValueError(f"{name} must be C-contiguous and writeable")
+    return out
 
 
 # Define Python Wrapper
-def image_to_graph(arr):
+def image_to_graph(arr, edges=None, weights=None, num_threads=None):
+    """
+    Compute the merge graph of a 2D image.
+    The results are written by the C library directly into NumPy-owned buffers; pass
+    edges (int) and weights (float64) arrays with the image shape to reuse them across calls.
+    num_threads sets the number of OpenMP threads (None uses the OpenMP default); the
+    result does not depend on it.
+    """
     # Check if the input is a NumPy array
     if not isinstance(arr, np.ndarray):
         raise TypeError("Input must be a NumPy array")
@@ -47,21 +74,63 @@ def image_to_graph(arr):
     if arr.ndim != 2:
         raise ValueError("Input array must be 2-dimensional")
 
-    # Check if the array is float32
-    #if arr.dtype != np.float32:
-    #    raise ValueError("Input array must have dtype 'float32'")
+    # Only copy when the input is not already C-contiguous float64
+    arr = np.ascontiguousarray(arr, dtype=np.float64)
 
     # Get the size of the array
     num_rows, num_cols = arr.shape
+    edges = _check_output(edges, arr.shape, np.intc, "edges")
+    weights = _check_output(weights, arr.shape, np.float64, "weights")
 
     # Call the C function
-    result_struct = graphom.computeGraph(arr.astype(np.float64), num_rows, num_cols)
-    edges = np.ctypeslib.as_array(result_struct.edges, shape=(num_rows, num_cols))
-    weights = np.ctypeslib.as_array(result_struct.weights, shape=(num_rows, num_cols))
+    if graphom.computeGraph(arr, num_rows, num_cols, edges, weights, num_threads or 0) != 0:
+        raise MemoryError("computeGraph failed to allocate its working memory")
 
     return edges, weights
 
 
+def image_to_tree_arrays(arr, num_threads=None):
+    """
+    Compute the persistent tree of a 2D image in a single native call.
+    Returns the flattened parents (-1 for the root) and labels of every pixel, the sorted
+    component labels with their birth (maximum) and death (minimum) values, and the root pixel.
+    """
+    # Check if the input is a NumPy array
+    if not isinstance(arr, np.ndarray):
+        raise TypeError("Input must be a NumPy array")
+
+    # Check if the array is 2-dimensional
+    if arr.ndim != 2:
+        raise ValueError("Input array must be 2-dimensional")
+
+    # Only copy when the input is not already C-contiguous float64
+    arr = np.ascontiguousarray(arr, dtype=np.float64)
+
+    # Get the size of the array
+    num_rows, num_cols = arr.shape
+    size = num_rows * num_cols
+
+    parents = np.empty(size, dtype=np.intc)
+    labels = np.empty(size, dtype=np.intc)
+    components = np.empty(size, dtype=np.intc)
+    births = np.empty(size, dtype=np.float64)
+    deaths = np.empty(size, dtype=np.float64)
+    root = ctypes.c_int(-1)
+
+    # Call the C function
+    num_components = graphom.computeTree(arr, num_rows, num_cols, parents, labels,
+                                         components, births, deaths, ctypes.byref(root), num_threads or 0)
+    if num_components < 0:
+        raise MemoryError("computeTree failed to allocate its working memory")
+
+    # Only keep the filled part of the per-component arrays
+    return (parents, labels,
+            components[:num_components].copy(),
+            births[:num_components].copy(),
+            deaths[:num_components].copy(),
+            root.value)
+
+
 def graph_to_image(edges, weights):
     A = np.zeros((edges.size,edges.size))
     A[np.arange(edges.size), edges.flatten()] = 1
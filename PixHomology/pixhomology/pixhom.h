@@ -13,12 +13,6 @@ extern "C" {
 #endif
 
 
-// Define a struct to store the result
-typedef struct {
-    double *data;
-    int length;
-} Result;
-
 // Define a struct to store information about u_points
 typedef struct {
     double u_val;
@@ -41,7 +35,9 @@ int compareUPoints(const void *a, const void *b);
 
 
 // Persistent Homology dimension 0 function
-MODULE_API Result computePH(double *inputArray, int numRows, int numCols);
+// Writes the diagram into the caller-allocated dgm array, returns the number of values written or -1 on allocation failure
+// numThreads <= 0 uses the OpenMP default number of threads
+MODULE_API int computePH(const double *inputArray, int numRows, int numCols, double *dgm, int numThreads);
 
 #ifdef __cplusplus
 }
@@ -3,11 +3,6 @@ import ctypes
 from pathlib import Path
 import sys
 
-# Define the Result structure in Python
-class Result(ctypes.Structure):
-    _fields_ = [("data", ctypes.POINTER(ctypes.c_double)),
-                ("length", ctypes.c_int)]
-
 # Define the C PixHomology function
 #print(Path(__file__).parent.parent)
 
@@ -33,12 +28,21 @@ pixhom = ctypes.CDLL(str(path / name))
 
 pixhom.computePH.argtypes = [np.ctypeslib.ndpointer(dtype=np.float64, ndim=2, flags='C_CONTIGUOUS'),
                                ctypes.c_int,
+                               ctypes.c_int,
+                               np.ctypeslib.ndpointer(dtype=np.float64, ndim=2, flags='C_CONTIGUOUS,WRITEABLE'),
                                ctypes.c_int]
-pixhom.computePH.restype = Result
+pixhom.computePH.restype = ctypes.c_int
 
 
 # Define Python Wrapper
-def computePH(arr):
+def computePH(arr, out=None, num_threads=None):
+    """
+    Compute the 0-dimensional persistence diagram of a 2D image.
+    The diagram is written by the C library into a NumPy-owned buffer of shape (rows * cols, 2),
+    which can be passed as out to reuse it across calls; the returned diagram is a view of it.
+    num_threads sets the number of OpenMP threads (None uses the OpenMP default); the
+    result does not depend on it.
+    """
     # Check if the input is a NumPy array
     if not isinstance(arr, np.ndarray):
         raise TypeError("Input must be a NumPy array")
@@ -47,15 +51,24 @@ def computePH(arr):
     if arr.ndim != 2:
         raise ValueError("Input array must be 2-dimensional")
 
-    # Check if the array is float32
-    #if arr.dtype != np.float32:
-    #    raise ValueError("Input array must have dtype 'float32'")
+    # Only copy when the input is not already C-contiguous float64
+    arr = np.ascontiguousarray(arr, dtype=np.float64)
 
     # Get the size of the array
     num_rows, num_cols = arr.shape
 
+    # A diagram has at most one pair per pixel
+    shape = (num_rows * num_cols, 2)
+    if out is None:
+        out = np.empty(shape, dtype=np.float64)
+    elif not isinstance(out, np.ndarray) or out.shape != shape or out.dtype != np.float64:
+        raise ValueError(f"out must be a NumPy array with shape {shape} and dtype 'float64'")
+    elif not out.flags.c_contiguous or not out.flags.writeable:
+        raise ValueError("out must be C-contiguous and writeable")
+
     # Call the C function
-    result_struct = pixhom.computePH(arr.astype(np.float64), num_rows, num_cols)
-    result = np.ctypeslib.as_array(result_struct.data, shape=(int(result_struct.length/2), 2))
+    length = pixhom.computePH(arr, num_rows, num_cols, out, num_threads or 0)
+    if length < 0:
+        raise MemoryError("computePH failed to allocate its working memory")
 
-    return result
+    return out[:length // 2]
@@ -0,0 +1,98 @@
+# benchmark_diffusion.py
+# python -m scripts.python.benchmark_diffusion [size ...]
+import sys
+import time
+import numpy as np
+from numba import njit, prange
+from src.topotree import Tree
+from src.anisodiff import _anisotropic_diffusion_stencil
+
+
+# per-node reference step, the stencil kernel must reproduce its output
+@njit(parallel=True)
+def _anisotropic_diffusion_step(N, values, node_labels, predecessors, rows, cols, alpha, spatial_sigma, intensity_sigma):
+    new_values = np.zeros(N, dtype=np.float64)
+
+    directions = [(-1, 0), (1, 0), (0, -1), (0, 1),
+                  (-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+    for node in prange(N):
+        current_value = values[node]
+        current_label = node_labels[node]
+        xi, yi = divmod(node, cols)
+
+        # collect neighbors: first parent (if any), then 8-connected neighbors
+        neighbor_idxs = []
+        #for pred in :
+        #if pred != -1:
+        neighbor_idxs.append(predecessors[node])
+
+        for dr, dc in directions:
+            nr, nc = xi + dr, yi + dc
+            if 0 <= nr < rows and 0 <= nc < cols:
+                j = int(nr * cols + nc)
+                #if j < N and labels[j] == current_label:
+                neighbor_idxs.append(j)
+
+        # Compute bilateral update
+        weight_sum = 0.0
+        update = 0.0
+
+        for k, n in enumerate(neighbor_idxs):
+            n_value = values[n]
+            xj, yj = divmod(n, cols)
+
+            spatial_dist = np.sqrt((xi - xj)**2 + (yi - yj)**2)
+            intensity_diff = n_value - current_value
+
+            w_spatial = np.exp(- (spatial_dist**2) / (2 * spatial_sigma**2))
+            w_intensity = np.exp(- (intensity_diff**2) / (2 * intensity_sigma**2))
+
+            weight =  w_intensity * w_spatial
+
+            update += weight * intensity_diff
+            weight_sum += weight
+
+        #if weight_sum > 0:
+        #    update /= weight_sum
+        new_values[node] = current_value + alpha * update
+
+    return new_values
+
+
+sizes = [int(s) for s in sys.argv[1:]] or [256, 500, 2048]
+repeats = 5
+alpha, spatial_sigma, intensity_sigma = 0.1, 1.0, 0.1
+
+rng = np.random.default_rng(0)
+
+print(f"{'Size':>10} | {'step (s)':>12} | {'stencil (s)':>12} | {'max diff':>10}")
+print("-" * 54)
+for size in sizes:
+    tree = Tree()
+    tree.from_image(rng.random((size, size)))
+    values = np.asarray(tree.get_node_values())
+    node_labels = tree.get_node_labels()
+    predecessors = tree.get_parents()
+    image = values.reshape(size, size)
+    out = np.empty_like(image)
+
+    # the first calls also compile the kernels
+    reference = _anisotropic_diffusion_step(values.size, values, node_labels, predecessors, size, size,
+                                            alpha, spatial_sigma, intensity_sigma)
+    _anisotropic_diffusion_stencil(image, predecessors, alpha, spatial_sigma, intensity_sigma, out)
+
+    step_times = []
+    stencil_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        _anisotropic_diffusion_step(values.size, values, node_labels, predecessors, size, size,
+                                    alpha, spatial_sigma, intensity_sigma)
+        step_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        _anisotropic_diffusion_stencil(image, predecessors, alpha, spatial_sigma, intensity_sigma, out)
+        stencil_times.append(time.perf_counter() - start)
+
+    max_diff = np.abs(reference - out.ravel()).max()
+    print(f"{f'{size}x{size}':>10} | {min(step_times):>12.4f} | {min(stencil_times):>12.4f} | {max_diff:>10.2e}")
@@ -0,0 +1,31 @@
+# benchmark_pixhomology.py
+# python -m scripts.python.benchmark_pixhomology [size ...]
+import sys
+import time
+import numpy as np
+import pixhomology as px
+from pixhomology.exp import image_to_graph
+
+sizes = [int(s) for s in sys.argv[1:]] or [128, 256, 512, 1024, 2048, 4096]
+repeats = 3
+
+rng = np.random.default_rng(0)
+
+print(f"{'Size':>10} | {'computeGraph (s)':>18} | {'computePH (s)':>18}")
+print("-" * 52)
+for size in sizes:
+    # uniform noise has a local maximum every few pixels, the worst case for the merge phase
+    image = rng.random((size, size))
+
+    graph_times = []
+    ph_times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        image_to_graph(image)
+        graph_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        px.computePH(image)
+        ph_times.append(time.perf_counter() - start)
+
+    print(f"{f'{size}x{size}':>10} | {min(graph_times):>18.4f} | {min(ph_times):>18.4f}")
@@ -0,0 +1,65 @@
+# benchmark_startup.py
+# python -m scripts.python.benchmark_startup [size]
+# Startup cost of a fresh job: each case runs in a new Python process with its own numba cache directory.
+# Build the ahead-of-time kernels first (python -m src.aot) to include the aot case.
+import os
+import subprocess
+import sys
+import tempfile
+
+size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+
+# first diffusion of a job, the part a SLURM task pays before doing any useful work
+first_call = f"""
+import time
+start = time.perf_counter()
+import numpy as np
+from src.topotree import CutTree
+from src.anisodiff import anisotropic_graph_diffusion
+imported = time.perf_counter()
+tree = CutTree()
+tree.from_image(np.random.default_rng(0).random(({size}, {size})))
+tree.cut()
+built = time.perf_counter()
+anisotropic_graph_diffusion(tree, steps=10)
+done = time.perf_counter()
+print(imported - start, built - imported, done - built)
+"""
+
+full_warmup = """
+import time
+start = time.perf_counter()
+from src.warmup import warmup
+imported = time.perf_counter()
+warmup()
+done = time.perf_counter()
+print(imported - start, 0.0, done - imported)
+"""
+
+
+def run(code, cache_dir, threads=None):
+    env = dict(os.environ, NUMBA_CACHE_DIR=cache_dir)
+    if threads is not None:
+        env['NUMBA_NUM_THREADS'] = str(threads)
+    out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    return [float(v) for v in out.stdout.split()]
+
+
+try:
+    from src import _anisodiff_aot
+    has_aot = True
+except ImportError:
+    has_aot = False
+
+print(f"{'Case':>40} | {'import (s)':>10} | {'tree (s)':>10} | {'kernels (s)':>11}")
+print("-" * 82)
+for name, code in [(f'first diffusion {size}x{size}', first_call), ('warmup()', full_warmup)]:
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cases = [('cold cache', run(code, cache_dir)), ('warm cache', run(code, cache_dir))]
+    if has_aot and code is first_call:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cases.append(('aot, 1 thread', run(code, cache_dir, threads=1)))
+    for case, (imported, built, kernels) in cases:
+        print(f"{name + ', ' + case:>40} | {imported:>10.2f} | {built:>10.2f} | {kernels:>11.2f}")
+if not has_aot:
+    print("aot case skipped, build it with: python -m src.aot")
@@ -3,6 +3,7 @@
 import sys
 from src.topotree import CutTree
 from src.anisodiff_exp import anisotropic_graph_diffusion
+from src.cache import TreeCache
 from astropy.io import fits
 import numpy as np
 from itertools import product
@@ -21,8 +22,7 @@ pattern = r'\d+\.\d+/image|image'
 
 gt = fits.getdata(re.sub(pattern, 'true', path))
 gt_norm = (gt - image.min()) / (image.max() - image.min())
-tree = CutTree()
-tree.from_image(image)
+tree = TreeCache().from_image(image, CutTree)
 level = tree.cut()
 #print(level)
 
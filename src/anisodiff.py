@@ -1,59 +1,131 @@
 import numpy as np
-from numba import njit, prange, int32
-from numba.typed import Dict
-
-
-
-@njit(parallel=True)
-def _anisotropic_diffusion_step(N, values, node_labels, predecessors, rows, cols, alpha, spatial_sigma, intensity_sigma):
-    new_values = np.zeros(N, dtype=np.float64)
-
-    directions = [(-1, 0), (1, 0), (0, -1), (0, 1),
-                  (-1, -1), (-1, 1), (1, -1), (1, 1)]
-
-    for node in prange(N):
-        current_value = values[node]
-        current_label = node_labels[node]
-        xi, yi = divmod(node, cols)
-
-        # collect neighbors: first parent (if any), then 8-connected neighbors
-        neighbor_idxs = []
-        #for pred in :
-        #if pred != -1:
-        neighbor_idxs.append(predecessors[node])
-
-        for dr, dc in directions:
-            nr, nc = xi + dr, yi + dc
-            if 0 <= nr < rows and 0 <= nc < cols:
-                j = int(nr * cols + nc)
-                #if j < N and labels[j] == current_label:
-                neighbor_idxs.append(j)
-
-        # Compute bilateral update
-        weight_sum = 0.0
-        update = 0.0
-
-        for k, n in enumerate(neighbor_idxs):
-            n_value = values[n]
-            xj, yj = divmod(n, cols)
-
-            spatial_dist = np.sqrt((xi - xj)**2 + (yi - yj)**2)
-            intensity_diff = n_value - current_value
-
-            w_spatial = np.exp(- (spatial_dist**2) / (2 * spatial_sigma**2))
-            w_intensity = np.exp(- (intensity_diff**2) / (2 * intensity_sigma**2))
-
-            weight =  w_intensity * w_spatial
-
-            update += weight * intensity_diff
-            weight_sum += weight
+import numba
+from numba import njit, prange
+
+try:
+    # serial ahead-of-time build of the stencil kernels, see src/aot.py
+    from . import _anisodiff_aot
+except ImportError:
+    _anisodiff_aot = None
+
+
+# 8-connected offsets, in the same order as the directions of the reference step in
+# scripts/python/benchmark_diffusion.py
+_NEIGHBOR_ROWS = np.array([-1, 1, 0, 0, -1, -1, 1, 1])
+_NEIGHBOR_COLS = np.array([0, 0, -1, 1, -1, 1, -1, 1])
+
+
+@njit(parallel=True, cache=True)
+def _anisotropic_diffusion_stencil(image, predecessors, alpha, spatial_sigma, intensity_sigma, out):
+    """
+    Same update as the per-node reference step of scripts/python/benchmark_diffusion.py, computed on the 2D image.
+    The spatial weights of the 8 offsets are computed once and the inner loop does not allocate.
+    """
+    rows, cols = image.shape
+    values = image.ravel()
+
+    w_spatial = np.empty(8, dtype=np.float64)
+    for k in range(8):
+        spatial_dist = np.sqrt(_NEIGHBOR_ROWS[k]**2 + _NEIGHBOR_COLS[k]**2)
+        w_spatial[k] = np.exp(- (spatial_dist**2) / (2 * spatial_sigma**2))
+    intensity_scale = 2 * intensity_sigma**2
+
+    for r in prange(rows):
+        for c in range(cols):
+            current_value = image[r, c]
+
+            # tree predecessor, -1 reads the last pixel like the reference step
+            pred = predecessors[r * cols + c]
+            xj, yj = divmod(pred, cols)
+            spatial_dist = np.sqrt((r - xj)**2 + (c - yj)**2)
+            intensity_diff = values[pred] - current_value
+            weight = np.exp(- (intensity_diff**2) / intensity_scale) * np.exp(- (spatial_dist**2) / (2 * spatial_sigma**2))
+            update = weight * intensity_diff
+
+            for k in range(8):
+                nr = r + _NEIGHBOR_ROWS[k]
+                nc = c + _NEIGHBOR_COLS[k]
+                if 0 <= nr < rows and 0 <= nc < cols:
+                    intensity_diff = image[nr, nc] - current_value
+                    update += np.exp(- (intensity_diff**2) / intensity_scale) * w_spatial[k] * intensity_diff
+
+            out[r, c] = current_value + alpha * update
+
+    return out
+
+
+@njit(parallel=True, cache=True)
+def _anisotropic_diffusion_sweep_step(images, predecessors, alphas, spatial_sigmas, intensity_sigmas, configs, out):
+    """
+    One _anisotropic_diffusion_stencil step of the configurations listed in configs, on a (K, rows, cols) stack.
+    The rows of all configurations are processed in a single parallel loop.
+    """
+    K, rows, cols = images.shape
+
+    w_spatial = np.empty((K, 8), dtype=np.float64)
+    for i in range(K):
+        for k in range(8):
+            spatial_dist = np.sqrt(_NEIGHBOR_ROWS[k]**2 + _NEIGHBOR_COLS[k]**2)
+            w_spatial[i, k] = np.exp(- (spatial_dist**2) / (2 * spatial_sigmas[i]**2))
+
+    for t in prange(len(configs) * rows):
+        i = configs[t // rows]
+        r = t % rows
+        image = images[i]
+        values = image.ravel()
+        intensity_scale = 2 * intensity_sigmas[i]**2
+        pred_scale = 2 * spatial_sigmas[i]**2
+
+        for c in range(cols):
+            current_value = image[r, c]
+
+            # tree predecessor, -1 reads the last pixel like the reference step
+            pred = predecessors[r * cols + c]
+            xj, yj = divmod(pred, cols)
+            spatial_dist = np.sqrt((r - xj)**2 + (c - yj)**2)
+            intensity_diff = values[pred] - current_value
+            weight = np.exp(- (intensity_diff**2) / intensity_scale) * np.exp(- (spatial_dist**2) / pred_scale)
+            update = weight * intensity_diff
+
+            for k in range(8):
+                nr = r + _NEIGHBOR_ROWS[k]
+                nc = c + _NEIGHBOR_COLS[k]
+                if 0 <= nr < rows and 0 <= nc < cols:
+                    intensity_diff = image[nr, nc] - current_value
+                    update += np.exp(- (intensity_diff**2) / intensity_scale) * w_spatial[i, k] * intensity_diff
+
+            out[i, r, c] = current_value + alphas[i] * update
+
+    return out
+
+
+@njit(cache=True)
+def _anisotropic_diffusion_loop(image, predecessors, steps, alpha, spatial_sigma, intensity_sigma, gth):
+    """
+    Whole diffusion loop, including the mse stopping check when gth is not empty.
+    Returns the buffer holding the last accepted image.
+    """
+    current = image.copy()
+    buffer = np.empty_like(image)
+    prev_mse = np.inf
+    for step in range(steps):
+        _anisotropic_diffusion_stencil(current, predecessors, alpha, spatial_sigma, intensity_sigma, buffer)
+        if gth.size > 0:
+            mse = np.mean(np.square(buffer - gth))
+            if mse < prev_mse:
+                prev_mse = mse
+            else:
+                break
+        current, buffer = buffer, current
 
-        #if weight_sum > 0:
-        #    update /= weight_sum
-        new_values[node] = current_value + alpha * update
+    return current
 
-    return new_values
 
+def _stencil_kernels():
+    # the ahead-of-time kernels do not run in parallel, they only replace the JIT ones on a single thread
+    if _anisodiff_aot is not None and numba.get_num_threads() == 1:
+        return _anisodiff_aot.stencil, _anisodiff_aot.sweep_step
+    return _anisotropic_diffusion_stencil, _anisotropic_diffusion_sweep_step
 
 
 def anisotropic_graph_diffusion(input_tree,
@@ -61,35 +133,101 @@ def anisotropic_graph_diffusion(input_tree,
                                 alpha=0.1,
                                 spatial_sigma=0.1,
                                 intensity_sigma=0.1,
-                                gth=None):
-
+                                gth=None,
+                                compiled=False):
+    """
+    Diffuse the node values of a copy of input_tree, stopping early when the mse to gth stops decreasing.
+    Two buffers are swapped between steps and the tree is only updated at the end.
+    compiled=True runs the whole loop in numba, its mse sums in a different order than numpy.
+    """
     tree = input_tree.copy()
 
     rows = tree.image_info['rows']
     cols = tree.image_info['cols']
-    node_labels = tree.get_node_labels()
+    predecessors = tree.get_parents()
+    image = np.array(tree.get_node_values(), dtype=np.float64).reshape(rows, cols)
+
+    if compiled:
+        gth = np.empty((0, 0)) if gth is None else np.asarray(gth, dtype=np.float64).reshape(rows, cols)
+        image = _anisotropic_diffusion_loop(image, predecessors, steps, alpha, spatial_sigma, intensity_sigma, gth)
+        tree.set_node_values(image.ravel())
+        return tree
 
-    N = len(node_labels)
-    tree_predecessors = tree.get_predecessors()
-    predecessors = -np.ones((N,), dtype=np.int32)
-    for i in range(N):
-        preds = tree_predecessors.get(i, [])
-        if preds:
-            predecessors[i] = preds[0]
+    if gth is not None:
+        gth = gth.flatten()
 
+    stencil, _ = _stencil_kernels()
+    buffer = np.empty_like(image)
     prev_mse = np.inf
     for step in range(steps):
-        values = tree.get_node_values()
-
-        new_values = _anisotropic_diffusion_step(N, values, node_labels, predecessors, rows, cols,
-                                                 alpha, spatial_sigma, intensity_sigma)
+        new_values = stencil(image, predecessors, alpha, spatial_sigma, intensity_sigma, buffer).ravel()
         if gth is not None:
-            mse = np.mean(np.square(new_values - gth.flatten()))
+            mse = np.mean(np.square(new_values - gth))
             if mse < prev_mse:
                 prev_mse = mse
                 #print(mse)
             else:
                 break
-        tree.set_node_values(new_values.tolist())
+        image, buffer = buffer, image
 
+    tree.set_node_values(image.ravel())
     return tree
+
+
+def anisotropic_graph_diffusion_sweep(input_tree,
+                                      gth,
+                                      spatial_sigmas,
+                                      intensity_sigmas,
+                                      alphas=0.1,
+                                      steps=100):
+    """
+    Run anisotropic_graph_diffusion for K configurations at once on a (K, N) value matrix.
+    Each configuration stops on its own when its mse to gth stops decreasing.
+    :param input_tree: tree to diffuse, it is not modified
+    :param gth: normalized ground truth image
+    :param spatial_sigmas: spatial sigma of each configuration
+    :param intensity_sigmas: intensity sigma of each configuration
+    :param alphas: step size of each configuration, scalars are broadcast
+    :param steps: maximum number of steps
+    :return: (tree with the best values, best configuration, its mse to gth)
+    """
+    spatial_sigmas, intensity_sigmas, alphas = [np.array(v, dtype=np.float64) for v in
+                                                np.broadcast_arrays(spatial_sigmas, intensity_sigmas, alphas)]
+    K = len(spatial_sigmas)
+
+    tree = input_tree.copy()
+
+    rows = tree.image_info['rows']
+    cols = tree.image_info['cols']
+    predecessors = tree.get_parents()
+    gth = gth.flatten()
+
+    images = np.empty((K, rows, cols), dtype=np.float64)
+    images[:] = np.asarray(tree.get_node_values()).reshape(rows, cols)
+    buffer = np.empty_like(images)
+    active = np.ones(K, dtype=np.bool_)
+    prev_mse = np.full(K, np.inf)
+
+    _, sweep_step = _stencil_kernels()
+    for step in range(steps):
+        sweep_step(images, predecessors, alphas, spatial_sigmas, intensity_sigmas, np.flatnonzero(active), buffer)
+        for i in np.flatnonzero(active):
+            mse = np.mean(np.square(buffer[i].ravel() - gth))
+            if mse < prev_mse[i]:
+                prev_mse[i] = mse
+            else:
+                # keep the last accepted image of a stopped configuration
+                active[i] = False
+                buffer[i] = images[i]
+        images, buffer = buffer, images
+        if not active.any():
+            break
+
+    best = int(np.argmin(prev_mse))
+    best_combination = {
+        'spatial_sigma': float(spatial_sigmas[best]),
+        'intensity_sigma': float(intensity_sigmas[best]),
+        'alpha': float(alphas[best])
+    }
+    tree.set_node_values(images[best].ravel())
+    return tree, best_combination, prev_mse[best]
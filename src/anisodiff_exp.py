@@ -1,7 +1,5 @@
 import numpy as np
 from numba import njit, prange
-from numba.typed import Dict
-from numba import types
 
 
 # Stopping criterion for linear anisotropic
@@ -46,21 +44,27 @@ def compute_h_t(h_entropy, t_steps):
         return np.inf
 
 
-@njit(parallel=True)
-def _anisotropic_diffusion_step(N, values, node_labels, predecessors, rows, cols, lifetimes_dict, maxdist_dict, alpha, spatial_sigma,
-                                intensity_sigma):
-    new_values = np.zeros(N, dtype=np.float64)
-
+@njit(parallel=True, cache=True)
+def _anisotropic_diffusion_step(N, values, predecessors, rows, cols, spatial_sigmas, intensity_sigmas, alpha,
+                                new_values, gth):
+    """
+    One diffusion step into new_values, with the reductions of the stopping criteria computed in the same pass.
+    spatial_sigmas and intensity_sigmas hold the sigmas of the component of every node.
+    Returns the sum of the new values, the sum of v log v over the positive ones and the squared error
+    to gth (0 when gth is empty).
+    """
+    total = 0.0
+    xlogx = 0.0
+    sse = 0.0
     directions = [(-1, 0), (1, 0), (0, -1), (0, 1),
                   (-1, -1), (-1, 1), (1, -1), (1, 1)]
 
     for node in prange(N):
         current_value = values[node]
-        current_label = node_labels[node]
         xi, yi = divmod(node, cols)
 
-        spatial_sigma = maxdist_dict[current_label]
-        intensity_sigma = lifetimes_dict[current_label]
+        spatial_sigma = spatial_sigmas[node]
+        intensity_sigma = intensity_sigmas[node]
 
         # collect neighbors: first parent (if any), then 8-connected neighbors
         neighbor_idxs = []
@@ -94,9 +98,82 @@ def _anisotropic_diffusion_step(N, values, node_labels, predecessors, rows, cols
 
         # if weight_sum > 0:
         #    update /= weight_sum
-        new_values[node] = current_value + alpha * update
+        new_value = current_value + alpha * update
+        new_values[node] = new_value
+
+        total += new_value
+        if new_value > 0:
+            xlogx += new_value * np.log(new_value)
+        if gth.size > 0:
+            sse += (new_value - gth[node]) ** 2
+
+    return total, xlogx, sse
+
+
+@njit(cache=True)
+def _entropy_from_sums(total, xlogx):
+    """
+    spatial_entropy from the sums returned by _anisotropic_diffusion_step:
+    -sum(p log p) with p = L / C and C = sum(L) is log C - sum(L log L) / C.
+    """
+    if total == 0:
+        return 0.0
+    return np.log(total) - xlogx / total
+
+
+_compute_h_t = njit(cache=True)(compute_h_t)
+
+
+@njit(cache=True)
+def _anisotropic_diffusion_loop(values, predecessors, rows, cols, spatial_sigmas, intensity_sigmas, steps, alpha, gth):
+    """
+    Whole diffusion loop with both stopping criteria, gth is only used when it is not empty.
+    Returns the last accepted values, the stopping step and the score.
+    """
+    N = len(values)
+    current = values.copy()
+    buffer = np.empty_like(values)
+
+    h_entropy = np.zeros(3)
+    t_steps = np.zeros(3)
+    h_change = np.full(3, np.inf)
+    prev_mse = np.inf
+    score = np.inf
+    step = 0
+    for step in range(steps):
+        total, xlogx, sse = _anisotropic_diffusion_step(N, current, predecessors, rows, cols,
+                                                        spatial_sigmas, intensity_sigmas, alpha, buffer, gth)
 
-    return new_values
+        if gth.size > 0:
+            mse = sse / N
+            if mse < prev_mse:
+                prev_mse = mse
+            else:
+                score = prev_mse
+                break
+        else:
+            h_entropy[:2] = h_entropy[1:].copy()
+            h_entropy[2] = _entropy_from_sums(total, xlogx)
+            t_steps[:2] = t_steps[1:].copy()
+            t_steps[2] = np.log(step + 1)
+            h_change[:2] = h_change[1:].copy()
+            h_change[2] = _compute_h_t(h_entropy, t_steps)
+
+            if h_change[1] < h_change[2] and h_change[2] != np.inf:
+                score = -h_entropy[0]
+                break
+
+        current, buffer = buffer, current
+
+    return current, step, score
+
+
+def _node_values(label_values, node_labels):
+    # labels are pixel indices: a dense table indexed by label, read at the label of every node
+    labels = np.fromiter(label_values.keys(), dtype=np.int64, count=len(label_values))
+    table = np.zeros(len(node_labels), dtype=np.float64)
+    table[labels] = np.fromiter(label_values.values(), dtype=np.float64, count=len(label_values))
+    return table[node_labels]
 
 
 def anisotropic_graph_diffusion(input_tree,
@@ -104,51 +181,54 @@ def anisotropic_graph_diffusion(input_tree,
                                 alpha=0.1,
                                 spatial_sigma=1,
                                 intensity_sigma=0.1,
-                                gth=None):
+                                gth=None,
+                                compiled=False):
+    """
+    Diffuse the node values of a copy of input_tree until the mse to gth, or the entropy criterion, stops improving.
+    Two buffers are swapped between steps and the tree is only updated at the end.
+    The mse and the entropy come from the sums computed by the diffusion kernel, without another pass
+    over the values. compiled=True runs the whole loop in numba.
+    The sigmas of every node are the max distance and the lifetime of its component, looked up once in dense
+    per-node arrays; spatial_sigma and intensity_sigma are not used.
+    """
     tree = input_tree.copy()
 
     rows = tree.image_info['rows']
     cols = tree.image_info['cols']
     node_labels = tree.get_node_labels()
-    lifetimes_dict = tree.get_lifetimes('dict')
-    maxdist_dict = tree.get_max_distances('dict')
-
-    lifetimes_numba = Dict.empty(key_type=types.int64, value_type=types.float64)
-    maxdist_numba = Dict.empty(key_type=types.int64, value_type=types.float64)
-    for k, v in lifetimes_dict.items():
-        lifetimes_numba[int(k)] = float(v)
-
-    for k, v in maxdist_dict.items():
-        maxdist_numba[int(k)] = float(v)
+    spatial_sigmas = _node_values(tree.get_max_distances('dict'), node_labels)
+    intensity_sigmas = _node_values(tree.get_lifetimes('dict'), node_labels)
 
     N = len(node_labels)
-    tree_predecessors = tree.get_predecessors()
-    predecessors = -np.ones((N,), dtype=np.int32)
-    for i in range(N):
-        preds = tree_predecessors.get(i, [])
-        if preds:
-            predecessors[i] = preds[0]
+    predecessors = tree.get_parents()
+    values = np.array(tree.get_node_values(), dtype=np.float64)
+
+    gth = np.empty(0) if gth is None else np.asarray(gth, dtype=np.float64).flatten()
+    if compiled:
+        values, step, score = _anisotropic_diffusion_loop(values, predecessors, rows, cols,
+                                                          spatial_sigmas, intensity_sigmas, steps, alpha, gth)
+        tree.set_node_values(values)
+        return tree, step, score
 
+    buffer = np.empty_like(values)
     h_entropy = [0,0,0]
     t_steps = [0, 0, 0]
     h_change = [np.inf, np.inf, np.inf]
     prev_mse = np.inf
     score = np.inf
     for step in range(steps):
-        values = tree.get_node_values()
+        total, xlogx, sse = _anisotropic_diffusion_step(N, values, predecessors, rows, cols,
+                                                        spatial_sigmas, intensity_sigmas, alpha, buffer, gth)
 
-        new_values = _anisotropic_diffusion_step(N, values, node_labels, predecessors, rows, cols,
-                                                 lifetimes_numba, maxdist_numba, alpha, spatial_sigma, intensity_sigma)
-
-        if gth is not None:
-            mse = np.mean(np.square(new_values - gth.flatten()))
+        if gth.size > 0:
+            mse = sse / N
             if mse < prev_mse:
                 prev_mse = mse
             else:
                 score = prev_mse
                 break
         else:
-            entropy = spatial_entropy(new_values)
+            entropy = _entropy_from_sums(total, xlogx)
             h_entropy.pop(0)
             h_entropy.append(entropy)
             t_steps.pop(0)
@@ -160,7 +240,7 @@ def anisotropic_graph_diffusion(input_tree,
                 score = -h_entropy[0]
                 break
 
-        tree.set_node_values(new_values.tolist())
+        values, buffer = buffer, values
 
+    tree.set_node_values(values)
     return tree, step, score
-
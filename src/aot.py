@@ -0,0 +1,41 @@
+"""
+Ahead-of-time build of the diffusion stencil kernels of src/anisodiff.py.
+
+python -m src.aot [output_dir]
+
+The extension module (_anisodiff_aot, next to this file by default) needs no compilation at import,
+so cold jobs skip the numba JIT of the kernels. numba does not build parallel kernels ahead of time,
+the module runs them serially and src/anisodiff.py only uses it when numba runs on a single thread,
+as the workers of src/batch.py do.
+"""
+import os
+import sys
+
+from numba.pycc import CC
+
+from .anisodiff import _anisotropic_diffusion_stencil, _anisotropic_diffusion_sweep_step
+
+
+MODULE_NAME = '_anisodiff_aot'
+
+
+def build(output_dir=None):
+    """
+    Compile the extension module into output_dir, the src directory by default.
+    :return: path of the compiled module
+    """
+    cc = CC(MODULE_NAME)
+    cc.output_dir = output_dir or os.path.dirname(os.path.abspath(__file__))
+
+    # images and buffers are C-contiguous float64, parents int32 and configurations int64, as in the drivers
+    cc.export('stencil', 'f8[:,::1](f8[:,::1], i4[::1], f8, f8, f8, f8[:,::1])')(
+        _anisotropic_diffusion_stencil.py_func)
+    cc.export('sweep_step', 'f8[:,:,::1](f8[:,:,::1], i4[::1], f8[::1], f8[::1], f8[::1], i8[::1], f8[:,:,::1])')(
+        _anisotropic_diffusion_sweep_step.py_func)
+
+    cc.compile()
+    return os.path.join(cc.output_dir, cc.output_file)
+
+
+if __name__ == '__main__':
+    print(build(sys.argv[1] if len(sys.argv) > 1 else None))
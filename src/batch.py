@@ -0,0 +1,179 @@
+"""
+Batch driver for the diffusion of many images in a single Python process per node.
+
+python -m src.batch "data/dataset/image/*.fits" --output-dir outputs/our --workers 8 --shard 0/4
+
+Images are shared between worker processes started once and warmed up, results are written as soon
+as each image is done and images whose output already exists are skipped, so that an interrupted
+run resumes where it stopped.
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+
+import numpy as np
+import numba
+
+from .topotree import CutTree
+from .anisodiff import anisotropic_graph_diffusion_sweep
+from .cache import TreeCache
+
+
+SPATIAL_SIGMA_VALUES = [0.5, 1, 2, 3, 4, 5, 10]
+INTENSITY_SIGMA_VALUES = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5]
+
+
+def truth_path(path):
+    # data/dataset/image/x.fits -> data/dataset/true/x.fits, data/mri/0.1/image/x.fits -> data/mri/true/x.fits
+    return re.sub(r'\d+\.\d+/image|image', 'true', path)
+
+
+def common_root(paths):
+    return os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+
+
+def output_path(path, root, output_dir):
+    return os.path.join(output_dir, os.path.relpath(path, root))
+
+
+def shard(paths, index, count):
+    """
+    Images of shard index out of count, every image belongs to exactly one shard.
+    """
+    return sorted(paths)[index::count]
+
+
+def process_image(path, output, steps=50, alpha=0.1, cache_dir=None, num_threads=None):
+    """
+    Cut the tree of the image, diffuse it with every sigma combination and write the best
+    reconstruction to output. scripts/python/process_image.py runs it on a single image.
+    :param num_threads: OpenMP threads used to build the tree, all the available cores by default
+    :return: dict with the path, best mse and best combination
+    """
+    # only the workers read and write FITS files, so --help and sharding work without astropy
+    from astropy.io import fits
+
+    image = fits.getdata(path)
+    gt = fits.getdata(truth_path(path))
+    gt_norm = (gt - image.min()) / (image.max() - image.min())
+
+    tree = TreeCache(cache_dir).from_image(image, CutTree, num_threads=num_threads)
+    tree.cut()
+
+    spatial_sigmas, intensity_sigmas = np.array(list(product(SPATIAL_SIGMA_VALUES, INTENSITY_SIGMA_VALUES))).T
+    new_tree, best_combination, _ = anisotropic_graph_diffusion_sweep(tree, gt_norm,
+                                                                      spatial_sigmas=spatial_sigmas,
+                                                                      intensity_sigmas=intensity_sigmas,
+                                                                      alphas=alpha,
+                                                                      steps=steps)
+    best_reconstruct = new_tree.to_image()
+    best_mse = float(np.mean((gt - best_reconstruct) ** 2))
+
+    # written under a temporary name, so that an interrupted write is not taken as done on resume
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    tmp = output + '.tmp'
+    fits.writeto(tmp, best_reconstruct, overwrite=True)
+    os.replace(tmp, output)
+
+    return {'path': path, 'output': output, 'mse': best_mse, 'combination': best_combination}
+
+
+def _warmup(num_threads, size=16):
+    # run the path of process_image once on a small image, which compiles the sweep kernels only
+    image = np.random.default_rng(0).random((size, size))
+    tree = CutTree()
+    tree.from_image(image, num_threads=num_threads)
+    tree.cut()
+    anisotropic_graph_diffusion_sweep(tree, image, spatial_sigmas=[1, 2], intensity_sigmas=[0.1, 0.2], steps=2)
+
+
+def _init_worker(num_threads):
+    # split the cores between the workers, for numba and for the OpenMP library building the trees,
+    # and compile the kernels before the first image
+    numba.set_num_threads(num_threads)
+    _warmup(num_threads)
+
+
+def run(paths, output_dir, workers=1, root=None, steps=50, alpha=0.1, cache_dir=None,
+        results_name='results.jsonl', log=sys.stdout):
+    """
+    Process the images on a pool of workers, skipping those whose output already exists.
+    One JSON line per processed image is appended to output_dir/results_name.
+    :param root: directory the output paths are relative to, the common directory of paths by default
+    :return: number of failed images
+    """
+    paths = sorted(paths)
+    if not paths:
+        return 0
+    root = root or common_root(paths)
+    outputs = {p: output_path(os.path.abspath(p), root, output_dir) for p in paths}
+    todo = [p for p in paths if not os.path.exists(outputs[p])]
+    print(f"{len(paths) - len(todo)} of {len(paths)} images already done", file=log, flush=True)
+    if not todo:
+        return 0
+
+    workers = max(1, min(workers, len(todo)))
+    num_threads = max(1, numba.config.NUMBA_NUM_THREADS // workers)
+    os.makedirs(output_dir, exist_ok=True)
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(num_threads,)) as pool, \
+            open(os.path.join(output_dir, results_name), 'a') as results:
+        futures = {pool.submit(process_image, p, outputs[p], steps, alpha, cache_dir, num_threads): p
+                   for p in todo}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                result = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"[{done}/{len(todo)}] {futures[future]} failed: {e!r}", file=log, flush=True)
+                continue
+            results.write(json.dumps(result) + '\n')
+            results.flush()
+            print(f"[{done}/{len(todo)}] {result['path']} -> Best MSE: {result['mse']} "
+                  f"Combination: {result['combination']}", file=log, flush=True)
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('inputs', nargs='*', help='images or glob patterns')
+    parser.add_argument('--file-list', help='file with one image path per line')
+    parser.add_argument('--output-dir', default='outputs/our')
+    parser.add_argument('--root', help='directory the output paths are relative to, '
+                                       'the common directory of the images by default')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--shard', default='0/1', help='i/n, process the i-th of n interleaved shards')
+    parser.add_argument('--steps', type=int, default=50)
+    parser.add_argument('--alpha', type=float, default=0.1)
+    parser.add_argument('--cache-dir', help='tree cache directory, see src.cache.TreeCache')
+    args = parser.parse_args(argv)
+
+    paths = []
+    for pattern in args.inputs:
+        paths.extend(glob.glob(pattern) if glob.has_magic(pattern) else [pattern])
+    if args.file_list:
+        with open(args.file_list) as f:
+            paths.extend(line.strip() for line in f if line.strip())
+    index, count = (int(v) for v in args.shard.split('/'))
+    if not 0 <= index < count:
+        parser.error(f"invalid shard {args.shard}")
+
+    # the root is taken over all the images, so that every shard writes to the same tree of outputs
+    root = args.root or (common_root(paths) if paths else None)
+    start = time.perf_counter()
+    failures = run(shard(set(paths), index, count), args.output_dir, workers=args.workers, root=root,
+                   steps=args.steps, alpha=args.alpha, cache_dir=args.cache_dir,
+                   # one results file per shard, shards may run on different nodes sharing the output directory
+                   results_name=f'results_{index}of{count}.jsonl')
+    print(f"Done in {time.perf_counter() - start:.1f}s, {failures} failed")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
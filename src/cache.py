@@ -0,0 +1,142 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from .topotree import Tree, TREE_FORMAT_VERSION
+
+
+# bumped whenever the tree built from an image changes, so that older entries are not reused
+TREE_BUILD_VERSION = 1
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'topotree')
+# age after which an unfinished entry is considered abandoned
+STALE_SECONDS = 24 * 3600
+
+
+class TreeCache:
+    """
+    On-disk cache of the trees built by Tree.from_image, keyed by a hash of the image.
+    Entries are written with Tree.save under a temporary name and renamed into place, so concurrent
+    writers of the same image never expose a partial entry. The least recently used entries are
+    removed when the cache grows over max_bytes.
+    """
+    def __init__(self, directory=None, max_bytes=10 * 2**30):
+        """
+        :param directory: cache directory, $TOPOTREE_CACHE_DIR or ~/.cache/topotree by default
+        :param max_bytes: size above which the least recently used entries are removed
+        """
+        self.directory = directory or os.environ.get('TOPOTREE_CACHE_DIR', DEFAULT_CACHE_DIR)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, image):
+        """
+        Hash of the image dtype, shape and bytes, and of the versions of the tree construction and format.
+        """
+        image = np.ascontiguousarray(image)
+        digest = hashlib.sha256()
+        digest.update(f'{TREE_BUILD_VERSION}:{TREE_FORMAT_VERSION}:{image.dtype.str}:{image.shape}:'.encode())
+        digest.update(image.data)
+        return digest.hexdigest()
+
+    def get(self, image, cls=Tree, mmap=True):
+        """
+        Cached tree of image loaded as cls, or None.
+        """
+        path = os.path.join(self.directory, self.key(image))
+        try:
+            tree = cls.load(path, mmap=mmap)
+        except (OSError, ValueError):
+            # missing, removed by another process or written by an older version
+            return None
+        # the modification time of the header orders the entries for eviction
+        try:
+            os.utime(os.path.join(path, 'header.json'))
+        except OSError:
+            pass
+        return tree
+
+    def put(self, image, tree):
+        """
+        Store the tree built from image. An entry already stored by another process is kept.
+        """
+        path = os.path.join(self.directory, self.key(image))
+        if os.path.exists(path):
+            return
+
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        try:
+            tree.save(tmp)
+            os.rename(tmp, path)
+        except OSError:
+            # lost the race with another writer
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+        self.evict()
+
+    def from_image(self, image, cls=Tree, num_threads=None):
+        """
+        Tree of image as built by cls().from_image(image), taken from the cache when possible.
+        :param num_threads: OpenMP threads used to build the tree on a miss
+        """
+        tree = self.get(image, cls)
+        if tree is None:
+            tree = cls()
+            tree.from_image(image, num_threads=num_threads)
+            self.put(image, tree)
+        return tree
+
+    def _entries(self):
+        # (last use, size, path) of every complete entry
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.tmp-'):
+                continue
+            try:
+                files = [os.path.join(path, f) for f in os.listdir(path)]
+                size = sum(os.path.getsize(f) for f in files)
+                last_use = os.path.getmtime(os.path.join(path, 'header.json'))
+            except OSError:
+                continue
+            entries.append((last_use, size, path))
+        return entries
+
+    def size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+        """
+        # leftovers of writers that died before renaming their entry
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if name.startswith('.tmp-') and time.time() - os.path.getmtime(path) > STALE_SECONDS:
+                    shutil.rmtree(path, ignore_errors=True)
+            except OSError:
+                pass
+
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            # renamed first, so that readers see either the whole entry or nothing
+            trash = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+            try:
+                os.rename(path, os.path.join(trash, 'entry'))
+            except OSError:
+                # already removed by another process
+                pass
+            shutil.rmtree(trash, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self._entries():
+            shutil.rmtree(path, ignore_errors=True)
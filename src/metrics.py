@@ -1,5 +1,8 @@
+import sys
 from apted import APTED, Config
 
+from .topotree import iter_postorder
+
 class MyNode:
     def __init__(self, label, children=None):
         self.label = label
@@ -17,50 +20,68 @@ class SimpleConfig(Config):
         return 1
 
 def build_my_tree(tree, index):
-    children = [build_my_tree(tree, c) for c in tree.successors.get(index, [])]
-    return MyNode(str(tree.node_labels[index]), children)
+    # built bottom-up from a postorder, so that deep trees do not hit the recursion limit
+    offsets = tree.children_offsets
+    labels = tree.node_labels
+    built = []
+    for node in iter_postorder(offsets, tree.children_indices, index):
+        num_children = offsets[node + 1] - offsets[node]
+        children = built[len(built) - num_children:]
+        del built[len(built) - num_children:]
+        built.append(MyNode(str(labels[node]), children))
+    return built[0]
 
 def fast_ted(tree1, tree2):
     t1 = build_my_tree(tree1, tree1.root)
     t2 = build_my_tree(tree2, tree2.root)
-    apted = APTED(t1, t2, SimpleConfig())
-    return apted.compute_edit_distance()
+    # apted indexes the nodes recursively, one frame per level
+    height = max(tree1.index.depths.max(), tree2.index.depths.max())
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, int(height) + 1000))
+    try:
+        apted = APTED(t1, t2, SimpleConfig())
+        return apted.compute_edit_distance()
+    finally:
+        sys.setrecursionlimit(limit)
 
 
 
 
 
-from scipy.sparse import csgraph, lil_matrix
-from scipy.sparse.linalg import eigsh
 import numpy as np
 
 def tree_to_sparse_adj_matrix(tree):
+    # one edge between every node and its parent, built in a single COO call
+    from scipy.sparse import coo_matrix
+
     n = len(tree)
-    A = lil_matrix((n, n))
-    for i, succs in tree.successors.items():
-        for j in succs:
-            A[i, j] = 1
-            A[j, i] = 1
-    return A.tocsr()
+    children = np.flatnonzero(tree.parents >= 0)
+    parents = tree.parents[children]
+    rows = np.concatenate([children, parents])
+    cols = np.concatenate([parents, children])
+    return coo_matrix((np.ones(len(rows)), (rows, cols)), shape=(n, n)).tocsr()
+
+def laplacian_spectrum(tree, k=20):
+    """
+    k smallest eigenvalues of the normalized Laplacian of the tree, in increasing order.
+    They are cached on the tree until its topology changes.
+    """
+    # scipy.sparse is only imported by the spectral distance
+    from scipy.sparse import csgraph
+    from scipy.sparse.linalg import eigsh
+
+    def compute(tree):
+        L = csgraph.laplacian(tree_to_sparse_adj_matrix(tree), normed=True)
+        # shift-invert just below 0, the smallest eigenvalue of a Laplacian, converges in a few iterations
+        # where which='SM' struggles; tree Laplacians factorize without fill-in
+        eigs = np.sort(eigsh(L, k=k, sigma=-1e-3, which='LM', return_eigenvectors=False))
+        eigs.flags.writeable = False
+        return eigs
+
+    return tree.cached(('laplacian_spectrum', k), compute)
 
 def spectral_distance(tree1, tree2, k=20):
-
-    A1 = tree_to_sparse_adj_matrix(tree1)
-    #print("A1")
-    A2 = tree_to_sparse_adj_matrix(tree2)
-    #print("A2")
-
-    L1 = csgraph.laplacian(A1, normed=True)
-    #print("L1")
-    L2 = csgraph.laplacian(A2, normed=True)
-    #print("L2")
-
-    eigs1 = np.sort(eigsh(L1, k=k, which='SM', return_eigenvectors=False))
-    #print("eigs1")
-    eigs2 = np.sort(eigsh(L2, k=k, which='SM', return_eigenvectors=False))
-    #print("eigs2")
+    eigs1 = laplacian_spectrum(tree1, k)
+    eigs2 = laplacian_spectrum(tree2, k)
 
     return np.linalg.norm(eigs1 - eigs2)
-
-
-
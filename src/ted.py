@@ -0,0 +1,310 @@
+"""
+Tree edit distances between the array trees of src.topotree, compiled with numba.
+
+The trees are walked iteratively in postorder, a cycle in the children index, such as the self-loops
+some cuts produce, raises ValueError. The exact distance costs O(n1 n2) memory, which rules out full
+500x500 trees (250k nodes each): the distance scripts still crop the images to 128x128 and use
+top_down_distance and lower_bound to skip or approximate the exact distance.
+"""
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def _postorder(offsets, indices, root):
+    """
+    Iterative postorder of the tree hanging from root.
+    A node reached from two parents is visited twice, like the recursive walks.
+    Returns the nodes in postorder and the postorder position of the leftmost leaf of each of them.
+    Raises ValueError when the walk exceeds the number of edges plus one, as it does on a cycle.
+    """
+    limit = len(indices) + 1
+    size = max(len(offsets) - 1, 1)
+    nodes = np.empty(size, dtype=np.int64)
+    leftmost = np.empty(size, dtype=np.int64)
+    count = 0
+
+    # stack of (node, next child to visit, postorder position of its first descendant)
+    stack_nodes = np.empty(64, dtype=np.int64)
+    stack_next = np.empty(64, dtype=np.int64)
+    stack_first = np.empty(64, dtype=np.int64)
+    stack_nodes[0] = root
+    stack_next[0] = offsets[root]
+    stack_first[0] = 0
+    top = 1
+
+    while top > 0:
+        node = stack_nodes[top - 1]
+        child_slot = stack_next[top - 1]
+        if child_slot < offsets[node + 1]:
+            stack_next[top - 1] = child_slot + 1
+            if top >= limit:
+                raise ValueError("cycle in tree")
+            if top == len(stack_nodes):
+                stack_nodes = np.concatenate((stack_nodes, np.empty_like(stack_nodes)))
+                stack_next = np.concatenate((stack_next, np.empty_like(stack_next)))
+                stack_first = np.concatenate((stack_first, np.empty_like(stack_first)))
+            child = indices[child_slot]
+            stack_nodes[top] = child
+            stack_next[top] = offsets[child]
+            stack_first[top] = count
+            top += 1
+        else:
+            if count >= limit:
+                raise ValueError("cycle in tree")
+            if count == len(nodes):
+                nodes = np.concatenate((nodes, np.empty_like(nodes)))
+                leftmost = np.concatenate((leftmost, np.empty_like(leftmost)))
+            nodes[count] = node
+            leftmost[count] = stack_first[top - 1]
+            count += 1
+            top -= 1
+
+    return nodes[:count], leftmost[:count]
+
+
+@njit(cache=True)
+def _keyroots(leftmost):
+    # the highest postorder position of every distinct leftmost leaf
+    n = len(leftmost)
+    is_keyroot = np.zeros(n, dtype=np.bool_)
+    seen = np.zeros(n, dtype=np.bool_)
+    for i in range(n - 1, -1, -1):
+        if not seen[leftmost[i]]:
+            seen[leftmost[i]] = True
+            is_keyroot[i] = True
+    return np.flatnonzero(is_keyroot)
+
+
+@njit(cache=True)
+def _zhang_shasha(labels1, leftmost1, keyroots1, labels2, leftmost2, keyroots2):
+    n1 = len(labels1)
+    n2 = len(labels2)
+    treedist = np.zeros((n1, n2), dtype=np.int32)
+    # flat so that the forest table of each pair of keyroots stays contiguous
+    forestdist = np.zeros((n1 + 1) * (n2 + 1), dtype=np.int32)
+
+    for i in keyroots1:
+        li = leftmost1[i]
+        for j in keyroots2:
+            lj = leftmost2[j]
+            stride = j - lj + 2
+
+            # forests of the subtrees rooted at i and j, shifted so that row and column 0 are empty
+            forestdist[0] = 0
+            for x in range(li, i + 1):
+                forestdist[(x - li + 1) * stride] = forestdist[(x - li) * stride] + 1
+            for y in range(lj, j + 1):
+                forestdist[y - lj + 1] = forestdist[y - lj] + 1
+
+            for x in range(li, i + 1):
+                row = (x - li + 1) * stride
+                subtree_row = (leftmost1[x] - li) * stride
+                whole_x = leftmost1[x] == li
+                for y in range(lj, j + 1):
+                    b = y - lj + 1
+                    delete = forestdist[row - stride + b] + 1
+                    insert = forestdist[row + b - 1] + 1
+                    if whole_x and leftmost2[y] == lj:
+                        rename = forestdist[row - stride + b - 1] + (labels1[x] != labels2[y])
+                        best = min(delete, insert, rename)
+                        treedist[x, y] = best
+                    else:
+                        subtree = forestdist[subtree_row + leftmost2[y] - lj] + treedist[x, y]
+                        best = min(delete, insert, subtree)
+                    forestdist[row + b] = best
+
+    return treedist[n1 - 1, n2 - 1]
+
+
+@njit(cache=True)
+def _structure(leftmost):
+    """
+    Parent and depth of every postorder position, and the children of every position
+    from left to right as a CSR index.
+    """
+    n = len(leftmost)
+    parent = -np.ones(n, dtype=np.int64)
+    for p in range(n):
+        c = p - 1
+        while c >= leftmost[p]:
+            parent[c] = p
+            c = leftmost[c] - 1
+
+    depth = np.zeros(n, dtype=np.int64)
+    for p in range(n - 2, -1, -1):
+        depth[p] = depth[parent[p]] + 1
+
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    for p in range(n - 1):
+        offsets[parent[p] + 1] += 1
+    offsets = np.cumsum(offsets)
+    children = np.empty(max(n - 1, 0), dtype=np.int64)
+    fill = offsets[:-1].copy()
+    for p in range(n - 1):
+        children[fill[parent[p]]] = p
+        fill[parent[p]] += 1
+
+    return depth, offsets, children
+
+
+@njit(cache=True)
+def _levels(depth, num_levels):
+    # positions grouped by depth and the rank of every position in its level
+    order = np.argsort(depth, kind='mergesort')
+    starts = np.zeros(num_levels + 1, dtype=np.int64)
+    for p in range(len(depth)):
+        if depth[p] < num_levels:
+            starts[depth[p] + 1] += 1
+    starts = np.cumsum(starts)
+    rank = np.empty(len(depth), dtype=np.int64)
+    for d in range(num_levels):
+        for r in range(starts[d + 1] - starts[d]):
+            rank[order[starts[d] + r]] = r
+    return order, starts, rank
+
+
+@njit(cache=True)
+def _top_down(labels1, leftmost1, labels2, leftmost2):
+    depth1, offsets1, children1 = _structure(leftmost1)
+    depth2, offsets2, children2 = _structure(leftmost2)
+    num_levels = min(depth1.max(), depth2.max()) + 1
+    order1, starts1, rank1 = _levels(depth1, num_levels)
+    order2, starts2, rank2 = _levels(depth2, num_levels)
+
+    max_children = 0
+    for p in range(len(leftmost2)):
+        max_children = max(max_children, offsets2[p + 1] - offsets2[p])
+    previous = np.zeros(max_children + 1, dtype=np.int64)
+    current = np.zeros(max_children + 1, dtype=np.int64)
+
+    # distances of the pairs of the level below, only pairs at the same depth are ever matched
+    below = np.zeros((0, 0), dtype=np.int64)
+    for d in range(num_levels - 1, -1, -1):
+        level = np.empty((starts1[d + 1] - starts1[d], starts2[d + 1] - starts2[d]), dtype=np.int64)
+        for a in range(level.shape[0]):
+            x = order1[starts1[d] + a]
+            for b in range(level.shape[1]):
+                y = order2[starts2[d] + b]
+
+                # sequence edit distance of the children, whole subtrees are inserted or deleted
+                previous[0] = 0
+                for j in range(offsets2[y], offsets2[y + 1]):
+                    cy = children2[j]
+                    previous[j - offsets2[y] + 1] = previous[j - offsets2[y]] + cy - leftmost2[cy] + 1
+                for i in range(offsets1[x], offsets1[x + 1]):
+                    cx = children1[i]
+                    size_x = cx - leftmost1[cx] + 1
+                    current[0] = previous[0] + size_x
+                    for j in range(offsets2[y], offsets2[y + 1]):
+                        cy = children2[j]
+                        k = j - offsets2[y] + 1
+                        current[k] = min(previous[k] + size_x,
+                                         current[k - 1] + cy - leftmost2[cy] + 1,
+                                         previous[k - 1] + below[rank1[cx], rank2[cy]])
+                    previous, current = current, previous
+
+                level[a, b] = previous[offsets2[y + 1] - offsets2[y]] + (labels1[x] != labels2[y])
+        below = level
+
+    return below[0, 0]
+
+
+def postorder(tree):
+    """
+    Postorder of a tree from its root.
+    :param tree: Tree or CutTree
+    :return: (nodes, leftmost) with leftmost the postorder position of the leftmost leaf of every node,
+             the subtree of nodes[i] spans positions leftmost[i] to i
+    """
+    offsets, indices = tree.get_children_arrays()
+    return _postorder(offsets, indices, tree.root)
+
+
+def _tree_arrays(tree):
+    nodes, leftmost = postorder(tree)
+    return np.asarray(tree.node_labels)[nodes], leftmost
+
+
+def tree_edit_distance(tree1, tree2):
+    """
+    Zhang-Shasha tree edit distance with unit insert and delete costs and a rename cost of 1
+    between different node labels, the cost model of metrics.fast_ted.
+    Time is O(n1 n2 min(depth, leaves)^2) and memory O(n1 n2) for trees of n1 and n2 nodes.
+    :param tree1: Tree or CutTree
+    :param tree2: Tree or CutTree
+    :return: edit distance
+    """
+    labels1, leftmost1 = _tree_arrays(tree1)
+    labels2, leftmost2 = _tree_arrays(tree2)
+
+    return int(_zhang_shasha(labels1, leftmost1, _keyroots(leftmost1),
+                             labels2, leftmost2, _keyroots(leftmost2)))
+
+
+def lower_bounds(tree1, tree2):
+    """
+    Lower bounds of tree_edit_distance, computed in linear time.
+    size: difference of the number of nodes
+    depth: difference of the heights, an edit changes the height by at most 1
+    degree: L1 distance of the degree histograms / 3, an edit changes at most 3 entries
+    label: nodes of the larger tree that cannot be matched to a node with the same label
+    :param tree1: Tree or CutTree
+    :param tree2: Tree or CutTree
+    :return: dict of lower bounds
+    """
+    labels1, leftmost1 = _tree_arrays(tree1)
+    labels2, leftmost2 = _tree_arrays(tree2)
+    depth1, offsets1, _ = _structure(leftmost1)
+    depth2, offsets2, _ = _structure(leftmost2)
+    n1 = len(labels1)
+    n2 = len(labels2)
+
+    degrees1 = np.bincount(np.diff(offsets1))
+    degrees2 = np.bincount(np.diff(offsets2))
+    size = max(len(degrees1), len(degrees2))
+    degree_l1 = np.abs(np.pad(degrees1, (0, size - len(degrees1))) - np.pad(degrees2, (0, size - len(degrees2)))).sum()
+
+    values1, counts1 = np.unique(labels1, return_counts=True)
+    values2, counts2 = np.unique(labels2, return_counts=True)
+    _, index1, index2 = np.intersect1d(values1, values2, assume_unique=True, return_indices=True)
+    common = np.minimum(counts1[index1], counts2[index2]).sum()
+
+    return {
+        'size': abs(n1 - n2),
+        'depth': abs(int(depth1.max()) - int(depth2.max())),
+        'degree': int(-(-degree_l1 // 3)),
+        'label': int(max(n1, n2) - common)
+    }
+
+
+def lower_bound(tree1, tree2):
+    """
+    Largest of lower_bounds.
+    """
+    return max(lower_bounds(tree1, tree2).values())
+
+
+def top_down_distance(tree1, tree2):
+    """
+    Top-down (Selkow) edit distance: nodes are only matched when their parents are, and whole subtrees
+    are inserted or deleted. Same costs as tree_edit_distance, of which it is an upper bound.
+    Time is the sum over the pairs of nodes at the same depth of the product of their number of children.
+    :param tree1: Tree or CutTree
+    :param tree2: Tree or CutTree
+    :return: edit distance
+    """
+    labels1, leftmost1 = _tree_arrays(tree1)
+    labels2, leftmost2 = _tree_arrays(tree2)
+    return int(_top_down(labels1, leftmost1, labels2, leftmost2))
+
+
+def approximate_tree_edit_distance(tree1, tree2):
+    """
+    Approximation of tree_edit_distance by top_down_distance.
+    :param tree1: Tree or CutTree
+    :param tree2: Tree or CutTree
+    :return: (distance, error bound), the exact distance lies in [distance - error bound, distance]
+    """
+    distance = top_down_distance(tree1, tree2)
+    return distance, distance - lower_bound(tree1, tree2)
@@ -1,22 +1,207 @@
 import numpy as np
 import copy
+import json
+import os
+from collections.abc import Mapping
 
-from scipy.spatial import cKDTree
-from scipy import ndimage
+from pixhomology.exp import image_to_tree_arrays
 
 from .utils import image_to_tree
+from .utils import normalize_image
+from .utils import edges_to_csr
 from .utils import max_jump_threshold
 from .utils import compute_max_distances
 
 
+# layout written by Tree.save, bumped whenever the saved arrays change
+TREE_FORMAT_VERSION = 2
+
+
+class PredecessorView(Mapping):
+    """
+    Read-only {node: [parent]} view over a parent array (-1 marks nodes without parent).
+    """
+    def __init__(self, parents):
+        self._parents = parents
+
+    def __getitem__(self, node):
+        if node not in self:
+            raise KeyError(node)
+        return [int(self._parents[node])]
+
+    def __contains__(self, node):
+        return 0 <= node < len(self._parents) and self._parents[node] >= 0
+
+    def __iter__(self):
+        return iter(np.flatnonzero(self._parents >= 0).tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(self._parents >= 0))
+
+
+class SuccessorView(Mapping):
+    """
+    Read-only {node: [children]} view over a CSR children index.
+    """
+    def __init__(self, offsets, indices):
+        self._offsets = offsets
+        self._indices = indices
+
+    def __getitem__(self, node):
+        if node not in self:
+            raise KeyError(node)
+        return self._indices[self._offsets[node]:self._offsets[node + 1]].tolist()
+
+    def __contains__(self, node):
+        return 0 <= node < len(self._offsets) - 1 and self._offsets[node] < self._offsets[node + 1]
+
+    def __iter__(self):
+        return iter(np.flatnonzero(np.diff(self._offsets)).tolist())
+
+    def __len__(self):
+        return int(np.count_nonzero(np.diff(self._offsets)))
+
+
+class TreeIndex:
+    """
+    Structural index of a tree: postorder numbering, subtree sizes, depths and an Euler tour
+    with a sparse table for lowest common ancestors. Queries are O(1) and accept arrays of nodes.
+    """
+    def __init__(self, parents, offsets, indices):
+        # numba is only imported when an index is built
+        from .utils import euler_tour
+
+        (self.postorder, self.post_number, self.sizes, self.depths,
+         self.euler, self.first, self.tree_roots) = euler_tour(parents, offsets, indices)
+
+        # sparse_table[k, i] is the shallowest Euler position in euler[i:i + 2 ** k]
+        euler_depths = self.depths[self.euler]
+        m = len(self.euler)
+        levels = max(m, 1).bit_length()
+        self._sparse_table = np.zeros((levels, m), dtype=np.int32)
+        self._sparse_table[0] = np.arange(m)
+        for k in range(1, levels):
+            half = 1 << (k - 1)
+            a = self._sparse_table[k - 1, :m - half]
+            b = self._sparse_table[k - 1, half:]
+            self._sparse_table[k, :m - half] = np.where(euler_depths[a] <= euler_depths[b], a, b)
+        self._log2 = np.zeros(m + 1, dtype=np.int64)
+        self._log2[2:] = np.floor(np.log2(np.arange(2, m + 1))).astype(np.int64)
+        self._euler_depths = euler_depths
+
+    def subtree_size(self, node):
+        return self.sizes[node]
+
+    def depth(self, node):
+        return self.depths[node]
+
+    def is_ancestor(self, u, v):
+        # u is an ancestor of v (or v itself) when v falls in the postorder interval of u
+        return (self.post_number[u] - self.sizes[u] < self.post_number[v]) & \
+               (self.post_number[v] <= self.post_number[u])
+
+    def lca(self, u, v):
+        """
+        Lowest common ancestor of u and v, -1 when they belong to different trees.
+        """
+        left = np.minimum(self.first[u], self.first[v])
+        right = np.maximum(self.first[u], self.first[v])
+        k = self._log2[right - left + 1]
+        a = self._sparse_table[k, left]
+        b = self._sparse_table[k, right - (1 << k) + 1]
+        ancestor = self.euler[np.where(self._euler_depths[a] <= self._euler_depths[b], a, b)]
+        return np.where(self.tree_roots[u] == self.tree_roots[v], ancestor, -1)
+
+
+def iter_preorder(offsets, indices, root):
+    """
+    Iterative preorder over a CSR children index, children from left to right.
+    A node reached from two parents is visited twice, like a recursive walk.
+    Only the children of the visited nodes are read, walking a small subtree costs its size.
+    Raises ValueError when the walk exceeds the number of edges plus one, as it does on a cycle.
+    """
+    limit = len(indices) + 1
+    stack = [root]
+    count = 0
+    while stack:
+        node = stack.pop()
+        count += 1
+        if count > limit:
+            raise ValueError("cycle in tree")
+        yield node
+        start, end = offsets[node], offsets[node + 1]
+        if start < end:
+            stack.extend(indices[start:end][::-1].tolist())
+
+
+def iter_postorder(offsets, indices, root):
+    """
+    Iterative postorder over a CSR children index, children from left to right.
+    A node reached from two parents is visited twice, like a recursive walk.
+    Only the children of the visited nodes are read, walking a small subtree costs its size.
+    Raises ValueError when the walk exceeds the number of edges plus one, as it does on a cycle.
+    """
+    limit = len(indices) + 1
+    count = 0
+    # stack of nodes and of the children of each of them left to visit, in reverse order
+    nodes = [root]
+    pending = [indices[offsets[root]:offsets[root + 1]][::-1].tolist()]
+    while nodes:
+        children = pending[-1]
+        if children:
+            child = children.pop()
+            count += 1
+            if count > limit:
+                raise ValueError("cycle in tree")
+            start, end = offsets[child], offsets[child + 1]
+            if start == end:
+                # leaves are yielded right away
+                yield child
+            else:
+                nodes.append(child)
+                pending.append(indices[start:end][::-1].tolist())
+        else:
+            pending.pop()
+            yield nodes.pop()
+
+
+def _insert_edge(parents, offsets, indices, u, v):
+    # grow the arrays if the edge refers to unseen nodes
+    size = max(u, v) + 1
+    if size > len(parents):
+        parents = np.concatenate([parents, -np.ones(size - len(parents), dtype=np.int32)])
+        offsets = np.concatenate([offsets, np.full(size + 1 - len(offsets), offsets[-1], dtype=np.int32)])
+
+    # a node keeps its first parent, as the dict version did with predecessors[v][0]
+    if parents[v] < 0:
+        parents[v] = u
+    indices = np.insert(indices, offsets[u + 1], v).astype(np.int32)
+    offsets[u + 1:] += 1
+    return parents, offsets, indices
+
+
+def _walk_up(parents, stop):
+    """
+    First ancestor (the node itself included) of every node that is flagged in stop.
+    Pointer jumping, nodes without parent must be flagged.
+    """
+    jump = np.where(stop, np.arange(len(parents)), parents)
+    while True:
+        next_jump = jump[jump]
+        if np.array_equal(next_jump, jump):
+            return jump
+        jump = next_jump
+
+
 class Tree:
     def __init__(self):
         self.image_info = {'rows': 0, 'cols': 0, 'min': 0, 'max': 0}
 
-        self.predecessors = {}
-        self.successors = {}
-        self.node_values = []
-        self.node_labels = []
+        self.parents = np.empty(0, dtype=np.int32)
+        self.children_offsets = np.zeros(1, dtype=np.int32)
+        self.children_indices = np.empty(0, dtype=np.int32)
+        self.node_values = np.empty(0, dtype=np.float64)
+        self.node_labels = np.empty(0, dtype=np.int32)
 
         self.components = []
         self.label_to_birth = {}
@@ -24,6 +209,33 @@ class Tree:
 
         self.root = None
 
+        # set when the topology arrays are shared with a copy of this tree
+        self._shared_topology = False
+        # data derived from the topology, computed on first use and dropped when the topology changes
+        self._cache = {}
+
+    @property
+    def predecessors(self):
+        return PredecessorView(self.parents)
+
+    @property
+    def successors(self):
+        return SuccessorView(self.children_offsets, self.children_indices)
+
+    @property
+    def index(self):
+        return self.cached('index', lambda tree: TreeIndex(tree.parents, tree.children_offsets,
+                                                           tree.children_indices))
+
+    def cached(self, key, compute):
+        """
+        Value of compute(self), kept under key until the topology of the tree changes.
+        Shallow copies share the cached values together with the topology.
+        """
+        if key not in self._cache:
+            self._cache[key] = compute(self)
+        return self._cache[key]
+
     def __len__(self):
         return len(self.node_values)
 
@@ -32,21 +244,16 @@ class Tree:
         label = self.node_labels[index]
         birth = self.label_to_birth[label]
         death = self.label_to_death[label]
-        if index in self.predecessors:
-            predecessors = self.predecessors[index]
-        else:
-            predecessors = []
-        if index in self.successors:
-            successors = self.successors[index]
-        else:
-            successors = []
 
         return {'value': value,
                 'label': label,
                 'birth': birth,
                 'death': death,
-                'predecessors': predecessors,
-                'successors': successors}
+                'predecessors': self.predecessors.get(index, []),
+                'successors': self.successors.get(index, [])}
+
+    def get_parents(self):
+        return self.parents
 
     def get_predecessors(self):
         return self.predecessors
@@ -54,6 +261,23 @@ class Tree:
     def get_successors(self):
         return self.successors
 
+    def get_children_arrays(self):
+        return self.children_offsets, self.children_indices
+
+    def preorder(self, node=None):
+        """
+        Iterate the nodes below node (the root by default) in preorder, following get_successors.
+        """
+        offsets, indices = self.get_children_arrays()
+        return iter_preorder(offsets, indices, self.root if node is None else node)
+
+    def postorder(self, node=None):
+        """
+        Iterate the nodes below node (the root by default) in postorder, following get_successors.
+        """
+        offsets, indices = self.get_children_arrays()
+        return iter_postorder(offsets, indices, self.root if node is None else node)
+
     def get_node_labels(self):
         return self.node_labels
 
@@ -61,24 +285,64 @@ class Tree:
         return self.node_values
 
     def set_node_values(self, values):
-        self.node_values = values
+        self.node_values = np.asarray(values, dtype=np.float64)
+
+    def _unshare_topology(self):
+        # take a private copy of the shared arrays before changing them in place
+        if self._shared_topology:
+            self.parents = self.parents.copy()
+            self.children_offsets = self.children_offsets.copy()
+            self.children_indices = self.children_indices.copy()
+            self._shared_topology = False
 
     def add_edge(self, u, v):
-        if u not in self.successors:
-            self.successors[u] = []
-        self.successors[u].append(v)
-        if v not in self.predecessors:
-            self.predecessors[v] = []
-        self.predecessors[v].append(u)
+        self._unshare_topology()
+        self._cache = {}
+        self.parents, self.children_offsets, self.children_indices = _insert_edge(
+            self.parents, self.children_offsets, self.children_indices, u, v)
 
     def add_edge_from_list(self, edges):
-        for v in range(len(edges)):
-            u = edges[v]
-            if u != v:
-                self.add_edge(u, v)
-
-    def from_image(self, image):
-        self.image_info, tree_info = image_to_tree(image)
+        edges = np.asarray(edges, dtype=np.int32)
+        nodes = np.arange(len(edges), dtype=np.int32)
+        self.parents = np.where(edges != nodes, edges, -1).astype(np.int32)
+        self._cache = {}
+        children = nodes[self.parents >= 0]
+        self.children_offsets, self.children_indices = edges_to_csr(self.parents[children], children, len(edges))
+
+    def from_arrays(self, image_info, parents, node_values, node_labels, components, births, deaths, root):
+        """
+        Set the tree from flat arrays, as returned by pixhomology.exp.image_to_tree_arrays.
+        births and deaths are aligned with the sorted component labels.
+        """
+        self.image_info = image_info
+
+        self.parents = np.asarray(parents, dtype=np.int32)
+        self._cache = {}
+        children = np.flatnonzero(self.parents >= 0).astype(np.int32)
+        self.children_offsets, self.children_indices = edges_to_csr(self.parents[children], children,
+                                                                    len(self.parents))
+        self.node_values = np.asarray(node_values, dtype=np.float64)
+        self.node_labels = np.asarray(node_labels, dtype=np.int32)
+        self.root = root
+
+        self.components = np.asarray(components)
+        self.label_to_birth = dict(zip(self.components.tolist(), np.asarray(births).tolist()))
+        self.label_to_death = dict(zip(self.components.tolist(), np.asarray(deaths).tolist()))
+
+    def from_image(self, image, fast=True, num_threads=None):
+        """
+        Build the tree of a 2D image.
+        :param fast: build it in a single native call, otherwise through image_to_tree
+        :param num_threads: OpenMP threads of the native library, all the available cores by default
+        """
+        if fast:
+            # single native call, no intermediate Python structures
+            image_info, image = normalize_image(image)
+            tree_arrays = image_to_tree_arrays(image, num_threads=num_threads)
+            self.from_arrays(image_info, tree_arrays[0], image.ravel(), *tree_arrays[1:])
+            return
+
+        self.image_info, tree_info = image_to_tree(image, num_threads=num_threads)
 
         self.node_labels = tree_info['node_labels']
         self.add_edge_from_list(tree_info['list_edges'])
@@ -118,16 +382,41 @@ class Tree:
         else:
             raise ValueError
 
-    def copy(self):
-        new_tree = Tree()
+    def copy(self, deep=False):
+        """
+        Copy the tree with its own node values.
+        The topology (parents, children, labels, components, birth and death) is shared with
+        this tree until add_edge changes it, deep=True copies every field.
+        """
+        new_tree = type(self)()
+
+        if not deep:
+            new_tree.image_info = dict(self.image_info)
+
+            new_tree.parents = self.parents
+            new_tree.children_offsets = self.children_offsets
+            new_tree.children_indices = self.children_indices
+            new_tree.node_values = self.node_values.copy()
+            new_tree.node_labels = self.node_labels
+
+            new_tree.components = self.components
+            new_tree.label_to_birth = self.label_to_birth
+            new_tree.label_to_death = self.label_to_death
+
+            new_tree.root = self.root
+
+            new_tree._cache = self._cache
+            self._shared_topology = new_tree._shared_topology = True
+            return new_tree
 
         # Copia profonda dei dizionari e liste
         new_tree.image_info = copy.deepcopy(self.image_info)
 
-        new_tree.predecessors = copy.deepcopy(self.predecessors)
-        new_tree.successors = copy.deepcopy(self.successors)
-        new_tree.node_values = copy.deepcopy(self.node_values)
-        new_tree.node_labels = copy.deepcopy(self.node_labels)
+        new_tree.parents = self.parents.copy()
+        new_tree.children_offsets = self.children_offsets.copy()
+        new_tree.children_indices = self.children_indices.copy()
+        new_tree.node_values = self.node_values.copy()
+        new_tree.node_labels = self.node_labels.copy()
 
         new_tree.components = copy.deepcopy(self.components)
         new_tree.label_to_birth = copy.deepcopy(self.label_to_birth)
@@ -137,114 +426,311 @@ class Tree:
 
         return new_tree
 
+    def _saved_arrays(self):
+        # arrays written by save, births and deaths are aligned with the keys of label_to_birth
+        labels = list(self.label_to_birth.keys())
+        return {
+            'parents': self.parents,
+            'children_offsets': self.children_offsets,
+            'children_indices': self.children_indices,
+            'node_values': self.node_values,
+            'node_labels': self.node_labels,
+            'components': np.asarray(self.components, dtype=np.int64),
+            'labels': np.asarray(labels, dtype=np.int64),
+            'births': np.asarray([self.label_to_birth[l] for l in labels], dtype=np.float64),
+            'deaths': np.asarray([self.label_to_death[l] for l in labels], dtype=np.float64)
+        }
+
+    def _set_saved_arrays(self, arrays):
+        self.parents = arrays['parents']
+        self.children_offsets = arrays['children_offsets']
+        self.children_indices = arrays['children_indices']
+        self.node_values = arrays['node_values']
+        self.node_labels = arrays['node_labels']
+
+        self.components = arrays['components']
+        labels = arrays['labels'].tolist()
+        self.label_to_birth = dict(zip(labels, arrays['births'].tolist()))
+        self.label_to_death = dict(zip(labels, arrays['deaths'].tolist()))
+
+    def save(self, path):
+        """
+        Save the tree to the directory path, one .npy file per array and a header.json with
+        the format version, image_info, the dtype of the image and root. The header is written last,
+        so an interrupted save is not loadable.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name, array in self._saved_arrays().items():
+            np.save(os.path.join(path, name + '.npy'), np.ascontiguousarray(array))
+
+        header = {
+            'version': TREE_FORMAT_VERSION,
+            'class': type(self).__name__,
+            'image_info': {
+                'rows': int(self.image_info['rows']),
+                'cols': int(self.image_info['cols']),
+                'min': np.asarray(self.image_info['min']).item(),
+                'max': np.asarray(self.image_info['max']).item()
+            },
+            # min and max are restored as scalars of the image dtype, so that to_image and cut
+            # compute in the same precision as on a freshly built tree
+            'image_dtype': np.asarray(self.image_info['min']).dtype.str,
+            'root': None if self.root is None else int(self.root)
+        }
+        with open(os.path.join(path, 'header.json'), 'w') as f:
+            json.dump(header, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load a tree written by save.
+        mmap=True maps the arrays from disk instead of reading them: pages are only read when used
+        and writes stay private to the process (copy-on-write), the files are never modified.
+        """
+        with open(os.path.join(path, 'header.json')) as f:
+            header = json.load(f)
+        if header['version'] != TREE_FORMAT_VERSION:
+            raise ValueError(f"Unsupported tree format version {header['version']}, "
+                             f"expected {TREE_FORMAT_VERSION}")
+
+        arrays = {}
+        for name in os.listdir(path):
+            if name.endswith('.npy'):
+                # plain ndarray views, so that numpy results are not memmap instances
+                arrays[name[:-4]] = np.asarray(np.load(os.path.join(path, name), mmap_mode='c' if mmap else None))
+
+        tree = cls()
+        tree.image_info = header['image_info']
+        image_dtype = np.dtype(header['image_dtype'])
+        tree.image_info['min'] = image_dtype.type(tree.image_info['min'])
+        tree.image_info['max'] = image_dtype.type(tree.image_info['max'])
+        tree.root = header['root']
+        tree._set_saved_arrays(arrays)
+        return tree
+
 
 class CutTree(Tree):
     def __init__(self):
         super().__init__()
-        self.predecessors_cut = {}
-        self.successors_cut = {}
-        self.node_labels_cut = {}
+        self.parents_cut = np.empty(0, dtype=np.int32)
+        self.children_offsets_cut = np.zeros(1, dtype=np.int32)
+        self.children_indices_cut = np.empty(0, dtype=np.int32)
+        self.node_labels_cut = np.empty(0, dtype=np.int32)
         self.components_cut = []
 
+        # set when the cut arrays are shared with a copy of this tree
+        self._shared_cut = False
+
+    @property
+    def predecessors_cut(self):
+        return PredecessorView(self.parents_cut)
+
+    @property
+    def successors_cut(self):
+        return SuccessorView(self.children_offsets_cut, self.children_indices_cut)
+
     def __getitem__(self, index):
         value = self.node_values[index]
         label = self.node_labels_cut[index]
         birth = self.label_to_birth[label]
         death = self.label_to_death[label]
-        if index in self.predecessors_cut:
-            predecessors = self.predecessors_cut[index]
-        else:
-            predecessors = []
-        if index in self.successors_cut:
-            successors = self.successors_cut[index]
-        else:
-            successors = []
 
         return {'value': value,
                 'label': label,
                 'birth': birth,
                 'death': death,
-                'predecessors': predecessors,
-                'successors': successors}
+                'predecessors': self.predecessors_cut.get(index, []),
+                'successors': self.successors_cut.get(index, [])}
+
+    def get_parents(self):
+        if len(self.parents_cut) > 0:
+            return self.parents_cut
+        return super().get_parents()
 
     def get_predecessors(self):
-        if self.predecessors_cut:
+        if len(self.parents_cut) > 0:
             return self.predecessors_cut
         return super().get_predecessors()
 
     def get_successors(self):
-        if self.successors_cut:
+        if len(self.parents_cut) > 0:
             return self.successors_cut
         return super().get_successors()
 
+    def get_children_arrays(self):
+        if len(self.parents_cut) > 0:
+            return self.children_offsets_cut, self.children_indices_cut
+        return super().get_children_arrays()
+
     def get_node_labels(self):
-        if self.node_labels_cut:
+        if len(self.node_labels_cut) > 0:
             return self.node_labels_cut
         return super().get_node_labels()
 
     def add_edge_cut(self, u, v):
-        if u not in self.successors_cut:
-            self.successors_cut[u] = []
-        self.successors_cut[u].append(v)
-        if v not in self.predecessors_cut:
-            self.predecessors_cut[v] = []
-        self.predecessors_cut[v].append(u)
+        if self._shared_cut:
+            self.parents_cut = self.parents_cut.copy()
+            self.children_offsets_cut = self.children_offsets_cut.copy()
+            self.children_indices_cut = self.children_indices_cut.copy()
+            self._shared_cut = False
+        self.parents_cut, self.children_offsets_cut, self.children_indices_cut = _insert_edge(
+            self.parents_cut, self.children_offsets_cut, self.children_indices_cut, u, v)
+
+    def from_arrays(self, *args, **kwargs):
+        super().from_arrays(*args, **kwargs)
+        self._reset_cut()
+
+    def from_image(self, image, fast=True, num_threads=None):
+        super().from_image(image, fast=fast, num_threads=num_threads)
+        self._reset_cut()
+
+    def _saved_arrays(self):
+        arrays = super()._saved_arrays()
+        if len(self.parents_cut) > 0:
+            arrays.update({
+                'parents_cut': self.parents_cut,
+                'children_offsets_cut': self.children_offsets_cut,
+                'children_indices_cut': self.children_indices_cut,
+                'node_labels_cut': self.node_labels_cut,
+                'components_cut': np.asarray(self.components_cut, dtype=np.int64)
+            })
+        return arrays
+
+    def _set_saved_arrays(self, arrays):
+        super()._set_saved_arrays(arrays)
+        # trees saved without a cut load with an empty one
+        self._reset_cut()
+        if 'parents_cut' in arrays:
+            self.parents_cut = arrays['parents_cut']
+            self.children_offsets_cut = arrays['children_offsets_cut']
+            self.children_indices_cut = arrays['children_indices_cut']
+            self.node_labels_cut = arrays['node_labels_cut']
+            self.components_cut = arrays['components_cut']
+
+    def _reset_cut(self):
+        # drop the cut computed on the previous image
+        self.parents_cut = np.empty(0, dtype=np.int32)
+        self.children_offsets_cut = np.zeros(1, dtype=np.int32)
+        self.children_indices_cut = np.empty(0, dtype=np.int32)
+        self.node_labels_cut = np.empty(0, dtype=np.int32)
+        self.components_cut = []
 
     def cut(self, level=None):
-        self.node_labels_cut = self.node_labels.copy()
         if level is None:
             level = max_jump_threshold(self.get_lifetimes())
         else:
             level = (level - self.image_info['min']) / (self.image_info['max'] - self.image_info['min'])
 
-        above_cut = {i for i in range(len(self))
-                     if self.label_to_birth[self.node_labels[i]] - \
-                     self.label_to_death[self.node_labels[i]] >= level}
-        below_cut = set(range(len(self))) - above_cut
+        self._cut(level, self._cut_context())
 
-        above_points = []
-        above_nodes = []
-        below_points = []
-
-        for u in above_cut:
-            ai, aj = divmod(u, self.image_info['cols'])
-            avalue = self.node_values[u]
-            above_points.append((aj, ai, avalue))
-            above_nodes.append(u)
-            for v in self.successors.get(u, []):
-                if v in above_cut:
-                    self.add_edge_cut(u, v)
+        return level * (self.image_info['max'] - self.image_info['min']) + self.image_info['min']
 
+    def cut_levels(self, levels):
+        """
+        Cut the tree at every level of levels (in image units), without modifying it.
+        The levels are processed in increasing order: the topology is shared between the cuts and
+        below-cut nodes whose nearest above-cut node survives the next level keep it.
+        :param levels: cut levels
+        :return: list of CutTree copies, one per level, each holding its own cut
+        """
+        context = self._cut_context()
+        levels = (np.asarray(levels, dtype=np.float64) - self.image_info['min']) / \
+                 (self.image_info['max'] - self.image_info['min'])
+
+        cuts = [None] * len(levels)
+        nearest = None
+        for i in np.argsort(levels, kind='stable'):
+            cuts[i] = self.copy()
+            nearest = cuts[i]._cut(levels[i], context, nearest)
+        return cuts
+
+    def _cut_context(self):
+        # level independent arrays of the cut, labels are pixel indices
+        N = len(self)
+        is_component = np.zeros(N, dtype=bool)
+        birth = np.zeros(N)
+        death = np.zeros(N)
+        labels = np.fromiter(self.label_to_birth.keys(), dtype=np.int64, count=len(self.label_to_birth))
+        is_component[labels] = True
+        birth[labels] = np.fromiter(self.label_to_birth.values(), dtype=np.float64, count=len(labels))
+        death[labels] = np.fromiter(map(self.label_to_death.get, labels.tolist()), dtype=np.float64, count=len(labels))
+
+        return {
+            'birth': birth,
+            'death': death,
+            'lifetimes': (birth - death)[self.node_labels],
+            # parent of every entry of children_indices
+            'sources': np.repeat(np.arange(N), np.diff(self.children_offsets)),
+            # nearest component root (the node itself included) of every node
+            'component_root': _walk_up(self.parents, is_component | (self.parents < 0))
+        }
+
+    def _cut(self, level, context, nearest=None):
+        """
+        Cut at a normalized level.
+        nearest holds the nearest above-cut node of the below-cut nodes of a lower level (-1 elsewhere),
+        only the nodes without a surviving one are queried again. Returns nearest for this level.
+        """
+        # scipy is only imported by the trees that are cut
+        from scipy import ndimage
+        from scipy.spatial import cKDTree
+
+        N = len(self)
+        cols = self.image_info['cols']
+        self.node_labels_cut = self.node_labels.copy()
+        birth = context['birth']
+        death = context['death']
+
+        above_cut = context['lifetimes'] >= level
+        if not above_cut.any():
+            # nothing lives long enough, every node hangs from the root
+            above_cut = above_cut.copy()
+            above_cut[self.root] = True
+        above_nodes = np.flatnonzero(above_cut)
+        below_nodes = np.flatnonzero(~above_cut)
+
+        # edges of the cut tree between nodes above the cut, grouped by parent
+        sources = context['sources']
+        keep = above_cut[sources] & above_cut[self.children_indices]
+        cut_sources = [sources[keep]]
+        cut_targets = [self.children_indices[keep]]
+
+        # every below-cut node hangs from the component of its nearest above-cut node in (x, y, value)
+        if nearest is None:
+            nearest = -np.ones(N, dtype=np.int64)
+        else:
+            nearest = np.where(above_cut[nearest] & (nearest >= 0), nearest, -1)
+        query_nodes = below_nodes[nearest[below_nodes] < 0]
+        above_points = np.column_stack((above_nodes % cols, above_nodes // cols, self.node_values[above_nodes]))
+        query_points = np.column_stack((query_nodes % cols, query_nodes // cols, self.node_values[query_nodes]))
         ckdtree = cKDTree(above_points)
-        for node in below_cut:
-            bi, bj = divmod(node, self.image_info['cols'])
-            avalue = self.node_values[node]
-            below_points.append((bj, bi, avalue))
-        distances, indices = ckdtree.query(below_points)
-        for best_candidate, node in zip(indices, below_cut):
-            actual_u = above_nodes[best_candidate.item()]
-            while actual_u not in self.label_to_birth:
-                actual_u = self.predecessors[actual_u][0]
-            if self.label_to_birth[actual_u] == self.label_to_death[actual_u]:
-                actual_u = self.predecessors[actual_u][0]
-
-            self.add_edge_cut(actual_u, node)
-            self.node_labels_cut[node] = actual_u
+        distances, indices = ckdtree.query(query_points)
+        nearest[query_nodes] = above_nodes[indices]
+
+        actual_u = context['component_root'][nearest[below_nodes]]
+        single = birth[actual_u] == death[actual_u]
+        actual_u[single] = self.parents[actual_u[single]]
+
+        cut_sources.append(actual_u)
+        cut_targets.append(below_nodes)
+        self.node_labels_cut[below_nodes] = actual_u
+
+        # every node has received at most one incoming edge so far
+        cut_sources = np.concatenate(cut_sources).astype(np.int32)
+        cut_targets = np.concatenate(cut_targets).astype(np.int32)
+        parents_cut = -np.ones(N, dtype=np.int32)
+        parents_cut[cut_targets] = cut_sources
 
         self.components_cut = np.unique(self.node_labels_cut)
 
         # PATCH 1
-        all_pred_cut = np.unique([x[0] for x in self.predecessors_cut.values()])
-        conversion = {}
-        for n in all_pred_cut:
-            p = n
-            while n not in self.components_cut and n in self.predecessors_cut:
-                n = self.predecessors_cut[n][0]
-            conversion[p] = n
-
-        for i in range(len(self.predecessors_cut)):
-            if i in self.predecessors_cut:
-                self.predecessors_cut[i][0] = conversion[self.predecessors_cut[i][0]]
+        has_parent = parents_cut >= 0
+        is_component_cut = np.zeros(N, dtype=bool)
+        is_component_cut[self.components_cut] = True
+        conversion = _walk_up(parents_cut, is_component_cut | ~has_parent)
+
+        head = parents_cut[:np.count_nonzero(has_parent)]
+        head[head >= 0] = conversion[head[head >= 0]]
 
         # PATCH 2
         mins = ndimage.minimum(self.node_values, self.node_labels_cut, index=self.components_cut)
@@ -256,18 +742,34 @@ class CutTree(Tree):
 
 
         # PATCH 3
-        lifetime_dict = self.get_lifetimes('dict')
-        for x in set(range(len(self))) - set(self.predecessors_cut):
-            if x != self.root:
-                xl = self.node_labels_cut[x]
-                l = self.label_to_birth[xl] - self.label_to_death[xl]
-                k = self.root
-                for k, v in lifetime_dict.items():
-                    if l < v:
-                        break
-                self.add_edge_cut(x, k)
+        # nodes without a parent hang below the first component that lives longer than theirs
+        orphans = np.flatnonzero(~has_parent)
+        orphans = orphans[orphans != self.root]
+        lifetimes_cut = maxs - mins
+        if len(lifetimes_cut) > 0:
+            # same order as get_lifetimes('dict')
+            order = np.argsort(lifetimes_cut, kind='stable')
+            orphan_lifetimes = lifetimes_cut[np.searchsorted(self.components_cut, self.node_labels_cut[orphans])]
+            position = np.searchsorted(lifetimes_cut[order], orphan_lifetimes, side='right')
+            targets = self.components_cut[order][np.minimum(position, len(order) - 1)]
+        else:
+            targets = np.full(len(orphans), self.root)
 
-        return level * (self.image_info['max'] - self.image_info['min']) + self.image_info['min']
+        # the first orphan pointing to a node without parent becomes its parent
+        first_targets, first = np.unique(targets, return_index=True)
+        free = parents_cut[first_targets] < 0
+        parents_cut[first_targets[free]] = orphans[first[free]]
+
+        cut_sources = np.concatenate([cut_sources, orphans]).astype(np.int32)
+        cut_targets = np.concatenate([cut_targets, targets]).astype(np.int32)
+
+        # the cut arrays are new, nothing is shared with copies of this tree anymore
+        self.parents_cut = parents_cut
+        self.children_offsets_cut, self.children_indices_cut = edges_to_csr(cut_sources, cut_targets, N)
+        self._shared_cut = False
+
+        nearest[above_nodes] = -1
+        return nearest
 
     def get_lifetimes(self, mode='list'):
         if mode == 'list':
@@ -304,26 +806,23 @@ class CutTree(Tree):
         segm[np.array(self.node_values) < bg_value] = 0
         return segm.reshape(self.image_info['rows'], self.image_info['cols'])
 
-    def copy(self):
-        new_tree = CutTree()
+    def copy(self, deep=False):
+        new_tree = super().copy(deep=deep)
 
-        # Copia profonda dei dizionari e liste
-        new_tree.image_info = copy.deepcopy(self.image_info)
-
-        new_tree.predecessors = copy.deepcopy(self.predecessors)
-        new_tree.successors = copy.deepcopy(self.successors)
-        new_tree.node_values = copy.deepcopy(self.node_values)
-        new_tree.node_labels = copy.deepcopy(self.node_labels)
+        if not deep:
+            new_tree.parents_cut = self.parents_cut
+            new_tree.children_offsets_cut = self.children_offsets_cut
+            new_tree.children_indices_cut = self.children_indices_cut
+            new_tree.node_labels_cut = self.node_labels_cut
+            new_tree.components_cut = self.components_cut
 
-        new_tree.components = copy.deepcopy(self.components)
-        new_tree.label_to_birth = copy.deepcopy(self.label_to_birth)
-        new_tree.label_to_death = copy.deepcopy(self.label_to_death)
-
-        new_tree.root = self.root
+            self._shared_cut = new_tree._shared_cut = True
+            return new_tree
 
-        new_tree.predecessors_cut = copy.deepcopy(self.predecessors_cut)
-        new_tree.successors_cut = copy.deepcopy(self.successors_cut)
-        new_tree.node_labels_cut = copy.deepcopy(self.node_labels_cut)
+        new_tree.parents_cut = self.parents_cut.copy()
+        new_tree.children_offsets_cut = self.children_offsets_cut.copy()
+        new_tree.children_indices_cut = self.children_indices_cut.copy()
+        new_tree.node_labels_cut = self.node_labels_cut.copy()
         new_tree.components_cut = copy.deepcopy(self.components_cut)
 
         return new_tree
@@ -1,30 +1,61 @@
 import numpy as np
-from scipy import ndimage
-from pixhomology.exp import image_to_graph
-from collections import defaultdict
-from scipy.spatial import ConvexHull, distance
 
 
-def check_neighbors(values):
-    center = values[4]
-    neighbors = np.delete(values, 4)
-    if np.all(neighbors == neighbors[0]):
-        return neighbors[0]
-    else:
-        return center
+def label_nodes(edges):
+    """
+    Assign to each pixel the root shared by all its 8 neighbours, or keep its own root otherwise.
+    Border pixels always keep their own root, since their neighbourhood falls outside the image.
+    :param edges: 2D array of roots returned by image_to_graph
+    :return: 2D array of labels
+    """
+    rows, cols = edges.shape
+    labels = edges.copy()
+    if rows < 3 or cols < 3:
+        return labels
+
+    # compare every neighbour with the top-left one using shifted views
+    first = edges[:-2, :-2]
+    same = np.ones(first.shape, dtype=bool)
+    for di in range(3):
+        for dj in range(3):
+            if (di, dj) in ((0, 0), (1, 1)):
+                continue
+            same &= edges[di:rows - 2 + di, dj:cols - 2 + dj] == first
 
+    labels[1:-1, 1:-1] = np.where(same, first, edges[1:-1, 1:-1])
+    return labels
 
-def image_to_tree(image):
-    rows, cols =  image.shape
+
+def normalize_image(image):
+    """
+    Rescale an image to [0, 1].
+    :param image: 2D array
+    :return: (image_info, normalized image)
+    """
+    rows, cols = image.shape
     min_ = image.min()
     max_ = image.max()
 
-    image = (image - min_) / (max_ - min_)
-    edges, _ = image_to_graph(image)
-    labels = ndimage.generic_filter(edges, check_neighbors, size=3, mode='constant', cval=np.nan)
-    node_labels = labels.flatten().tolist()
-    list_edges = edges.flatten().tolist()
-    node_values = image.flatten().tolist()
+    image_info = {
+        'rows': rows,
+        'cols': cols,
+        'min': min_,
+        'max': max_
+    }
+    return image_info, (image - min_) / (max_ - min_)
+
+
+def image_to_tree(image, num_threads=None):
+    # only needed by the slow path of Tree.from_image
+    from scipy import ndimage
+    from pixhomology.exp import image_to_graph
+
+    image_info, image = normalize_image(image)
+    edges, _ = image_to_graph(image, num_threads=num_threads)
+    labels = label_nodes(edges)
+    node_labels = labels.ravel().astype(np.int32)
+    list_edges = edges.ravel().astype(np.int32)
+    node_values = image.ravel().astype(np.float64)
     root = np.argmax(node_values)
 
     unique_labels = np.unique(node_labels)
@@ -35,12 +66,6 @@ def image_to_tree(image):
     label_to_death = dict(zip(unique_labels, mins.tolist()))
     label_to_birth = dict(zip(unique_labels, maxs.tolist()))
 
-    image_info = {
-        'rows': rows,
-        'cols': cols,
-        'min': min_,
-        'max': max_
-    }
     tree_info = {
         'root': root,
         'node_labels': node_labels,
@@ -53,6 +78,97 @@ def image_to_tree(image):
     return image_info, tree_info
 
 
+def edges_to_csr(sources, targets, num_nodes):
+    """
+    Build a CSR children index from an edge list.
+    Edges sharing the same source keep their insertion order.
+    :param sources: array of parent nodes
+    :param targets: array of child nodes
+    :param num_nodes: number of nodes in the tree
+    :return: (offsets, indices) with the children of u in indices[offsets[u]:offsets[u + 1]]
+    """
+    sources = np.asarray(sources, dtype=np.int32)
+    targets = np.asarray(targets, dtype=np.int32)
+    order = np.argsort(sources, kind='stable')
+    offsets = np.zeros(num_nodes + 1, dtype=np.int32)
+    np.cumsum(np.bincount(sources, minlength=num_nodes), out=offsets[1:])
+    return offsets, targets[order]
+
+
+def _euler_tour(parents, offsets, indices):
+    """
+    Depth-first walk of the forest given by a parent array, children visited in CSR order.
+    A child listed under a node that is not its parent is skipped, so every node is visited once.
+    :param parents: array of parents, -1 for roots
+    :param offsets: CSR offsets of the children
+    :param indices: CSR children
+    :return: (postorder, post_number, sizes, depths, euler, first, tree_roots) with post_number the
+             postorder position of every node, euler the Euler tour, first the first Euler position of
+             every node and tree_roots the root of the tree of every node (-1 for unvisited nodes)
+    """
+    n = len(parents)
+    postorder = np.empty(n, dtype=np.int64)
+    post_number = -np.ones(n, dtype=np.int64)
+    sizes = np.ones(n, dtype=np.int64)
+    depths = np.zeros(n, dtype=np.int64)
+    euler = np.empty(2 * n, dtype=np.int64)
+    first = -np.ones(n, dtype=np.int64)
+    tree_roots = -np.ones(n, dtype=np.int64)
+
+    stack_nodes = np.empty(n, dtype=np.int64)
+    stack_next = np.empty(n, dtype=np.int64)
+    count = 0
+    tour = 0
+    for root in range(n):
+        if parents[root] >= 0:
+            continue
+        stack_nodes[0] = root
+        stack_next[0] = offsets[root]
+        top = 1
+        first[root] = tour
+        euler[tour] = root
+        tour += 1
+        tree_roots[root] = root
+
+        while top > 0:
+            node = stack_nodes[top - 1]
+            slot = stack_next[top - 1]
+            if slot < offsets[node + 1]:
+                stack_next[top - 1] = slot + 1
+                child = indices[slot]
+                if parents[child] != node:
+                    continue
+                depths[child] = depths[node] + 1
+                tree_roots[child] = root
+                first[child] = tour
+                euler[tour] = child
+                tour += 1
+                stack_nodes[top] = child
+                stack_next[top] = offsets[child]
+                top += 1
+            else:
+                post_number[node] = count
+                postorder[count] = node
+                count += 1
+                top -= 1
+                if top > 0:
+                    parent = stack_nodes[top - 1]
+                    sizes[parent] += sizes[node]
+                    euler[tour] = parent
+                    tour += 1
+
+    return postorder[:count], post_number, sizes, depths, euler[:tour], first, tree_roots
+
+
+def __getattr__(name):
+    # numba kernels are compiled on first access, so that importing utils does not import numba
+    if name == 'euler_tour':
+        from numba import njit
+        globals()[name] = njit(cache=True)(_euler_tour)
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def max_jump_threshold(lifetimes):
     """
     from: https://www.frontiersin.org/journals/applied-mathematics-and-statistics/articles/10.3389/fams.2024.1260828/full
@@ -69,15 +185,17 @@ def max_jump_threshold(lifetimes):
 
 
 def compute_max_distances(labels, M):
-    max_distances = {}
-    for idx, label in enumerate(labels):
-        xc, yc = divmod(label, M)
-        x, y = divmod(idx, M)
-        d = np.sqrt((xc - x) ** 2 + (yc - y) ** 2)
-        if label in max_distances:
-            d_back = max_distances[label]
-            if d > d_back:
-                max_distances[label] = d_back
-        else:
-            max_distances[label] = d
-    return max_distances
\ No newline at end of file
+    """
+    Distance of every label (a pixel index) to the first pixel carrying it in raster order.
+    :param labels: array of node labels
+    :param M: number of columns of the image
+    :return: dict {label: distance} in order of first appearance
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    unique_labels, first = np.unique(labels, return_index=True)
+    order = np.argsort(first)
+    unique_labels, first = unique_labels[order], first[order]
+    xc, yc = np.divmod(unique_labels, M)
+    x, y = np.divmod(first, M)
+    d = np.sqrt((xc - x) ** 2 + (yc - y) ** 2)
+    return dict(zip(unique_labels.tolist(), d.tolist()))
@@ -0,0 +1,36 @@
+import numpy as np
+
+from .topotree import Tree, CutTree
+from .anisodiff import anisotropic_graph_diffusion, anisotropic_graph_diffusion_sweep
+from . import anisodiff_exp
+from .ted import top_down_distance, tree_edit_distance, lower_bound
+
+
+def warmup(size=16):
+    """
+    Compile every numba kernel of the package by running it once on a small random image.
+    The drivers always pass float64 values, int32 parents and int64 indices, so these are the only
+    signatures compiled. With the on-disk numba cache (cache=True) this only loads the kernels after
+    the first run on a machine.
+    :param size: side of the image used for the warm-up
+    """
+    rng = np.random.default_rng(0)
+    image = rng.random((size, size))
+
+    tree = Tree()
+    tree.from_image(image)
+    cut_tree = CutTree()
+    cut_tree.from_image(image)
+    cut_tree.cut()
+
+    for t in (tree, cut_tree):
+        t.index
+        anisotropic_graph_diffusion(t, steps=2, gth=image)
+        anisotropic_graph_diffusion(t, steps=2, gth=image, compiled=True)
+        anisodiff_exp.anisotropic_graph_diffusion(t, steps=2, gth=image)
+        anisodiff_exp.anisotropic_graph_diffusion(t, steps=4, compiled=True)
+    anisotropic_graph_diffusion_sweep(cut_tree, image, spatial_sigmas=[1, 2], intensity_sigmas=[0.1, 0.2], steps=2)
+
+    top_down_distance(tree, cut_tree)
+    tree_edit_distance(cut_tree, cut_tree)
+    lower_bound(tree, cut_tree)
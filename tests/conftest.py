@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the package is used from the repository root, with PixHomology next to it
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, 'PixHomology')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from src.cache import TreeCache
+from src.topotree import CutTree
+
+
+def images():
+    rng = np.random.default_rng(0)
+    # integer FITS images are big-endian, and max - min overflows in int16 here
+    int16 = rng.integers(-30000, 30000, (20, 24)).astype(np.int16)
+    return {
+        'float32': rng.random((20, 24)).astype(np.float32) * 1e3 - 10,
+        'int16': int16,
+        'int16 big-endian': int16.astype('>i2'),
+    }
+
+
+@pytest.mark.parametrize('name', list(images()))
+def test_cached_tree_matches_fresh_tree(tmp_path, name):
+    image = images()[name]
+    cache = TreeCache(str(tmp_path))
+    fresh = cache.from_image(image, CutTree)
+    cached = cache.get(image, CutTree)
+    assert cached is not None
+
+    for key in ('min', 'max'):
+        assert type(cached.image_info[key]) is type(fresh.image_info[key])
+        assert cached.image_info[key] == fresh.image_info[key]
+
+    # bit for bit, a hit gives the output of a miss
+    with np.errstate(over='ignore'):
+        fresh_image, cached_image = fresh.to_image(), cached.to_image()
+    assert fresh_image.dtype == cached_image.dtype
+    assert fresh_image.tobytes() == cached_image.tobytes()
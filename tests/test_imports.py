@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+HEAVY = ['numba', 'scipy.spatial', 'scipy.sparse', 'apted']
+
+# seconds, numpy alone takes about 70 ms and scipy plus numba several hundred more
+IMPORT_BUDGET = 0.25
+
+
+def run_fresh(code):
+    # a fresh interpreter, modules imported by the test session would hide the heavy imports
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.path.join(ROOT, 'PixHomology')]))
+    return subprocess.run([sys.executable, '-c', code], cwd=ROOT, env=env,
+                          capture_output=True, text=True, check=True).stdout.strip()
+
+
+@pytest.mark.parametrize('module', ['src.topotree', 'src.utils', 'src.cache'])
+def test_import_is_lazy(module):
+    code = (f"import sys, {module}; "
+            f"print(','.join(m for m in {HEAVY!r} if m in sys.modules))")
+    assert run_fresh(code) == ''
+
+
+@pytest.mark.parametrize('module', ['pixhomology', 'src.topotree', 'src.utils', 'src.cache'])
+def test_import_time(module):
+    code = ("import time; start = time.perf_counter(); "
+            f"import {module}; print(time.perf_counter() - start)")
+    # best of a few runs, the first one may read the files from a cold disk
+    elapsed = min(float(run_fresh(code)) for _ in range(3))
+    assert elapsed < IMPORT_BUDGET, f"import {module} took {elapsed * 1000:.0f} ms"
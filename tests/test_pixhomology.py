@@ -0,0 +1,77 @@
+import ctypes
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from pixhomology import pixhom
+from pixhomology.exp import graphom
+
+from conftest import ROOT
+
+SOURCES = {'pixhom': 'pixhomology/pixhom.c', 'graphom': 'pixhomology/exp/graphom.c'}
+FUNCTIONS = {'pixhom': ['computePH'], 'graphom': ['computeGraph', 'computeTree']}
+
+
+def build(name, directory, defines=()):
+    source_dir = os.path.join(ROOT, 'PixHomology')
+    library = os.path.join(directory, f'lib{name}.so')
+    subprocess.run(['gcc', '-O2', '-fopenmp', '-shared', '-fPIC', '-I', source_dir, *defines,
+                    os.path.join(source_dir, SOURCES[name]), '-o', library], check=True)
+    lib = ctypes.CDLL(library)
+    wrapper = {'pixhom': pixhom.pixhom, 'graphom': graphom.graphom}[name]
+    for function in FUNCTIONS[name]:
+        getattr(lib, function).argtypes = getattr(wrapper, function).argtypes
+        getattr(lib, function).restype = getattr(wrapper, function).restype
+    return lib
+
+
+@pytest.fixture(scope='module')
+def libraries(tmp_path_factory):
+    # the radix sort (default) and qsort variants of both libraries, built from the sources in the tree
+    if shutil.which('gcc') is None:
+        pytest.skip('gcc is required to build the libraries')
+    radix = tmp_path_factory.mktemp('radix')
+    qsort = tmp_path_factory.mktemp('qsort')
+    return {name: (build(name, str(radix)), build(name, str(qsort), ['-DPIXHOM_USE_QSORT']))
+            for name in SOURCES}
+
+
+def images():
+    rng = np.random.default_rng(0)
+    subnormal = np.finfo(np.float64).smallest_subnormal
+    return {
+        'random': rng.random((40, 50)),
+        # many equal values, so equal u_val and equal c_val between u_points
+        'ties': np.round(rng.random((40, 40)) * 3),
+        'plateaus': np.kron(rng.integers(0, 4, (8, 8)), np.ones((5, 5))).astype(np.float64),
+        'signed zero': rng.choice([-0.0, 0.0, 1.0, -1.0], (30, 30)),
+        'subnormal': rng.integers(-4, 5, (30, 30)) * subnormal,
+        'mixed': rng.choice([-np.inf, -1.0, -subnormal, -0.0, 0.0, subnormal, 1e-300, 1.0], (30, 30)),
+        'constant': np.zeros((6, 6)),
+        'single': np.ones((1, 1)),
+    }
+
+
+def outputs(image):
+    dgm = pixhom.computePH(image)
+    edges, weights = graphom.image_to_graph(image)
+    return [dgm, edges, weights, *graphom.image_to_tree_arrays(image)]
+
+
+@pytest.mark.parametrize('name', list(images()))
+def test_radix_sort_matches_qsort(libraries, monkeypatch, name):
+    image = images()[name]
+    results = []
+    for variant in range(2):
+        monkeypatch.setattr(pixhom, 'pixhom', libraries['pixhom'][variant])
+        monkeypatch.setattr(graphom, 'graphom', libraries['graphom'][variant])
+        results.append(outputs(image))
+
+    for radix, qsort in zip(*results):
+        radix, qsort = np.asarray(radix), np.asarray(qsort)
+        assert radix.dtype == qsort.dtype and radix.shape == qsort.shape
+        # bit for bit, so that -0.0 and 0.0 are told apart
+        assert radix.tobytes() == qsort.tobytes()
@@ -0,0 +1,78 @@
+from functools import lru_cache
+
+import numpy as np
+import pytest
+
+from src.topotree import Tree, CutTree
+from src.ted import tree_edit_distance, top_down_distance, lower_bound
+
+
+def as_forest(tree):
+    # nested (label, children) tuples, children from left to right
+    offsets, indices = tree.get_children_arrays()
+    labels = np.asarray(tree.node_labels)
+
+    def subtree(node, path):
+        if node in path:
+            raise ValueError("cycle in tree")
+        children = indices[offsets[node]:offsets[node + 1]]
+        return (int(labels[node]), tuple(subtree(c, path | {node}) for c in children))
+    return (subtree(tree.root, frozenset()),)
+
+
+def forest_size(forest):
+    return sum(1 + forest_size(children) for _, children in forest)
+
+
+@lru_cache(maxsize=None)
+def forest_distance(f, g):
+    # edit distance of ordered forests, recursing on the rightmost trees
+    if not f:
+        return forest_size(g)
+    if not g:
+        return forest_size(f)
+    (v, v_children), (w, w_children) = f[-1], g[-1]
+    return min(forest_distance(f[:-1] + v_children, g) + 1,
+               forest_distance(f, g[:-1] + w_children) + 1,
+               forest_distance(v_children, w_children) + forest_distance(f[:-1], g[:-1]) + (v != w))
+
+
+def trees():
+    rng = np.random.default_rng(0)
+    result = []
+    for shape in [(2, 3), (3, 3), (3, 4), (2, 5)]:
+        for _ in range(3):
+            tree = CutTree()
+            tree.from_image(rng.integers(0, 4, shape).astype(np.float64))
+            result.append(tree)
+            for level in (0.3, 0.6):
+                cut = tree.copy()
+                cut.cut(level)
+                result.append(cut)
+    return result
+
+
+def test_tree_edit_distance_matches_brute_force():
+    all_trees = trees()
+    for tree1 in all_trees:
+        for tree2 in all_trees[::3]:
+            try:
+                expected = forest_distance(as_forest(tree1), as_forest(tree2))
+            except ValueError:
+                # a cut with a cycle, see test_cycle_raises
+                continue
+            distance = tree_edit_distance(tree1, tree2)
+            assert distance == expected
+            assert lower_bound(tree1, tree2) <= distance <= top_down_distance(tree1, tree2)
+
+
+def test_cycle_raises():
+    # the cut makes the root its own child
+    tree = CutTree()
+    tree.from_image(np.array([[0, 3, 0, 3], [0, 1, 1, 3]], dtype=np.float64))
+    tree.cut(0.3)
+    other = Tree()
+    other.from_image(np.arange(4, dtype=np.float64).reshape(2, 2))
+    for distance in (tree_edit_distance, top_down_distance, lower_bound):
+        with pytest.raises(ValueError, match='cycle in tree'):
+            distance(tree, other)
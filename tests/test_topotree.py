@@ -0,0 +1,39 @@
+import sys
+
+import numpy as np
+import pytest
+
+from src.topotree import Tree, CutTree
+
+
+def chain(size):
+    # every node is the parent of the next one
+    tree = Tree()
+    tree.add_edge_from_list(np.concatenate([[0], np.arange(size - 1)]))
+    tree.node_labels = np.arange(size, dtype=np.int32) % 3
+    tree.root = 0
+    return tree
+
+
+def test_deep_chain_walks():
+    from src.metrics import fast_ted
+
+    size = 5000
+    tree = chain(size)
+    assert list(tree.preorder()) == list(range(size))
+    assert list(tree.postorder()) == list(range(size - 1, -1, -1))
+
+    limit = sys.getrecursionlimit()
+    assert fast_ted(tree, tree) == 0
+    assert fast_ted(tree, chain(size - 10)) == 10
+    assert sys.getrecursionlimit() == limit
+
+
+def test_walks_raise_on_cycle():
+    # the cut makes the root its own child
+    tree = CutTree()
+    tree.from_image(np.array([[0, 3, 0, 3], [0, 1, 1, 3]], dtype=np.float64))
+    tree.cut(0.3)
+    for walk in (tree.preorder, tree.postorder):
+        with pytest.raises(ValueError, match='cycle in tree'):
+            list(walk())
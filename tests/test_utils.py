@@ -0,0 +1,83 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from pixhomology.exp import image_to_graph
+from src.utils import label_nodes
+
+from conftest import ROOT
+
+
+def check_neighbors(values):
+    # reference labelling of the generic_filter implementation
+    center = values[4]
+    neighbors = np.delete(values, 4)
+    if np.all(neighbors == neighbors[0]):
+        return neighbors[0]
+    else:
+        return center
+
+
+def reference_labels(edges):
+    return ndimage.generic_filter(edges, check_neighbors, size=3, mode='constant', cval=np.nan)
+
+
+def fixture_images(limit=3):
+    # FORECAST and MRI patches written by data/create_dataset.py and data/create_mri_dataset.py
+    paths = []
+    for pattern in ('data/dataset/image/*.fits', 'data/dataset/true/*.fits',
+                    'data/mri_dataset/*/image/*.fits', 'data/mri_dataset/true/*.fits'):
+        paths.extend(sorted(glob.glob(os.path.join(ROOT, pattern)))[:limit])
+    return paths
+
+
+FIXTURES = fixture_images()
+
+
+def synthetic_images():
+    rng = np.random.default_rng(0)
+    # point sources on a noisy background, like the FORECAST patches
+    sky = rng.normal(0, 0.01, (96, 96))
+    for r, c in rng.integers(0, 96, (15, 2)):
+        sky[r, c] += rng.uniform(0.5, 2)
+    sky = ndimage.gaussian_filter(sky, 1.5) + rng.normal(0, 0.002, sky.shape)
+    # smooth anatomy plus noise, like the MRI slices
+    mri = ndimage.gaussian_filter(rng.random((80, 64)), 4) + 0.1 * rng.standard_normal((80, 64))
+    return {
+        'sky': sky,
+        'mri': mri,
+        'random': rng.random((50, 70)),
+        # many ties between neighbouring roots
+        'quantised': np.round(rng.random((40, 40)) * 4) / 4,
+        'constant': np.zeros((8, 8)),
+        'thin': rng.random((2, 30)),
+    }
+
+
+def assert_same_labels(image):
+    # normalised as in image_to_tree
+    image = np.asarray(image, dtype=np.float64)
+    image = (image - image.min()) / (image.max() - image.min())
+    edges, _ = image_to_graph(np.nan_to_num(image))
+    labels = label_nodes(edges)
+    reference = reference_labels(edges)
+    assert labels.dtype == reference.dtype
+    np.testing.assert_array_equal(labels, reference)
+    # as used by image_to_tree
+    np.testing.assert_array_equal(labels.ravel().astype(np.int32), reference.ravel().astype(np.int32))
+
+
+@pytest.mark.parametrize('name', list(synthetic_images()))
+def test_label_nodes_matches_generic_filter(name):
+    assert_same_labels(synthetic_images()[name])
+
+
+@pytest.mark.skipif(not FIXTURES, reason='no FORECAST or MRI patches under data/, '
+                                         'run data/create_dataset.py and data/create_mri_dataset.py')
+def test_label_nodes_matches_generic_filter_on_fixtures():
+    fits = pytest.importorskip('astropy.io.fits')
+    for path in FIXTURES:
+        assert_same_labels(fits.getdata(path))